@@ -0,0 +1,205 @@
+#!/bin/env python3
+import csv
+import math
+import argparse
+import numpy as np
+import pandas as pd
+import settings
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from charts import stop_below
+from marketdata import CandleStore
+from scanner import load_universe, candle_arrays, bar_scores, score_window, find_levels, targets
+
+TRADE_HEADERS = ['ticker','signal_date','entry_time','entry','stop','r1','r2','amount','exit_time','exit_price','exit_reason','source','pnl']
+SELLOFF_MINUTE = 15*60 + 40     # checkprice sells everything from 15:40 New York
+
+def signal_days(candles,days=120):
+    # indexes of the daily bars a scan run after that bar's close would have
+    # shortlisted, with the first bar of the days long window each one saw
+    opens, highs, lows, closes = candle_arrays(candles)
+    red, bull, bear = bar_scores(opens,highs,lows,closes)
+    red = red.tolist()
+    bull = bull.tolist()
+    bear = bear.tolist()
+    dates = np.array([np.datetime64(value,'D') for value in candles.index.get_level_values(-1)])
+    starts = np.searchsorted(dates,dates - np.timedelta64(days,'D'))
+    signals = []
+    for end, start in enumerate(starts.tolist()):
+        if end - start < 3 or closes[end] <= 0.1:
+            continue
+        scores = score_window(red,bull,bear,opens,closes,end,start)
+        if scores['bear_steps'] > 0 and scores['bounce_steps'] > 0:
+            signals.append((end,start))
+    return signals
+
+def first_hit(mask,start):
+    hits = np.flatnonzero(mask[start:])
+    return start + hits[0] if hits.size else None
+
+def replay_day(bars,limit,stop,above,trade_limit):
+    # the next session for one signal: a limit buy at the scan price, then
+    # the trigger ladder check_triggers works through, the stop selling
+    # everything and the lowest Above trigger selling amount/divide, until
+    # the 15:40 selloff. A bar that reaches both the stop and a target is
+    # counted as stopped out.
+    opens = bars['open'].to_numpy(dtype=float)
+    highs = bars['high'].to_numpy(dtype=float)
+    lows = bars['low'].to_numpy(dtype=float)
+    closes = bars['close'].to_numpy(dtype=float)
+    stamps = bars.index.get_level_values(-1)
+    minutes = np.array([stamp.hour*60 + stamp.minute for stamp in stamps]) if hasattr(stamps[0],'hour') else np.zeros(len(bars),dtype=int)
+    selloff = minutes >= SELLOFF_MINUTE
+    entry_at = first_hit((lows <= limit) & ~selloff,0)
+    if entry_at is None:
+        return None
+    entry = min(opens[entry_at],limit)
+    amount = math.floor(trade_limit/entry)
+    if amount <= 0:
+        return None
+    ladder = sorted((price,name) for price, name in zip(above,('r1','r2')) if price is not None)
+    remaining = amount
+    proceeds = 0
+    pos = entry_at
+    reason = 'close'
+    exit_at = len(bars) - 1
+    while remaining > 0:
+        selloff_at = first_hit(selloff,pos)
+        stop_at = first_hit(lows <= stop,pos)
+        target_at = first_hit(highs >= ladder[0][0],pos) if ladder else None
+        events = [(at,rank,kind) for at, rank, kind in ((selloff_at,0,'selloff'),(stop_at,1,'stop'),(target_at,2,'target')) if at is not None]
+        if not events:
+            proceeds += remaining * closes[-1]
+            remaining = 0
+            break
+        exit_at, rank, reason = min(events)
+        if reason == 'selloff':
+            proceeds += remaining * opens[exit_at]
+            remaining = 0
+        elif reason == 'stop':
+            proceeds += remaining * min(opens[exit_at],stop)
+            remaining = 0
+        else:
+            divide = max(len(ladder)-1,1)
+            to_sell = remaining if divide == 1 else math.floor(remaining/divide)
+            target, reason = ladder.pop(0)
+            proceeds += to_sell * max(opens[exit_at],target)
+            remaining -= to_sell
+            pos = exit_at
+    return {
+        'entry_time':stamps[entry_at],
+        'entry':entry,
+        'amount':amount,
+        'exit_time':stamps[exit_at],
+        'exit_price':proceeds / amount,
+        'exit_reason':reason,
+        'pnl':proceeds - amount * entry,
+        }
+
+def backtest_ticker(ticker,start,end,days=120,trade_limit=150,path='qtrader.db'):
+    # every trade the rules would have taken on one ticker, intraday bars
+    # are used for the session when they are stored, the daily bar otherwise
+    store = CandleStore(path)
+    daily = store.load([ticker],start - timedelta(days=days),end,'1d').get(ticker)
+    if daily is None or len(daily.index) <= 3:
+        return []
+    intraday = store.load([ticker],start,end + timedelta(days=1),'5m').get(ticker)
+    sessions = {}
+    if intraday is not None:
+        stamps = intraday.index.get_level_values(-1)
+        for session, rows in pd.Series(np.arange(len(stamps))).groupby(stamps.date):
+            sessions[session] = rows.to_numpy()
+    dates = daily.index.get_level_values(-1)
+    lows = daily['low'].to_numpy(dtype=float)
+    closes = daily['close'].to_numpy(dtype=float)
+    trades = []
+    for signal, window in signal_days(daily,days):
+        if signal + 1 >= len(dates) or dates[signal] < start.date():
+            continue
+        price = closes[signal]
+        candles = daily.iloc[window:signal+1]
+        size_mean,levels = find_levels(candles)
+        levels.sort()
+        r1,r2 = targets(levels,price)
+        stop = stop_below(lows[window:signal+1],price)
+        session = dates[signal+1]
+        if session in sessions:
+            bars = intraday.iloc[sessions[session]]
+            source = '5m'
+        else:
+            bars = daily.iloc[signal+1:signal+2]
+            source = '1d'
+        trade = replay_day(bars,price,stop,(r1,r2),trade_limit)
+        if trade is None:
+            continue
+        trade.update({'ticker':ticker,'signal_date':dates[signal],'stop':stop,'r1':r1,'r2':r2,'source':source})
+        trades.append(trade)
+    return trades
+
+def summarize(trades):
+    pnl = np.array([trade['pnl'] for trade in sorted(trades,key=lambda trade:str(trade['entry_time']))],dtype=float)
+    if not pnl.size:
+        return {'trades':0,'total_pnl':0}
+    equity = np.cumsum(pnl)
+    wins = pnl[pnl > 0]
+    losses = pnl[pnl < 0]
+    return {
+        'trades':int(pnl.size),
+        'wins':int(wins.size),
+        'losses':int(losses.size),
+        'win_rate':wins.size / pnl.size,
+        'total_pnl':float(equity[-1]),
+        'avg_pnl':float(pnl.mean()),
+        'avg_win':float(wins.mean()) if wins.size else 0,
+        'avg_loss':float(losses.mean()) if losses.size else 0,
+        'profit_factor':float(wins.sum() / -losses.sum()) if losses.size else math.inf,
+        'max_drawdown':float((np.maximum.accumulate(np.maximum(equity,0)) - equity).max()),
+        }
+
+def run_backtest(tickers,start,end,days=120,trade_limit=150,workers=None,path='qtrader.db',on_progress=None):
+    # one ticker per task, each process reads its own candles from sqlite
+    workers = workers or getattr(settings,'scan_workers',8)
+    trades = []
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(backtest_ticker,tickers,[start]*len(tickers),[end]*len(tickers),[days]*len(tickers),[trade_limit]*len(tickers),[path]*len(tickers),chunksize=16)
+        for ticker_trades in results:
+            trades.extend(ticker_trades)
+            done += 1
+            if on_progress:
+                on_progress(done,len(tickers))
+    return trades
+
+def export_trades(trades,path=None):
+    path = path or 'backtest_' + datetime.now().strftime("%Y%m%d_%H%M%S") + '.csv'
+    with open(path,'w',newline='') as csvfile:
+        csvwriter = csv.DictWriter(csvfile,fieldnames=TRADE_HEADERS,extrasaction='ignore')
+        csvwriter.writeheader()
+        for trade in sorted(trades,key=lambda trade:(str(trade['entry_time']),trade['ticker'])):
+            csvwriter.writerow(trade)
+    return path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay the scan rules and trigger exits over stored candles")
+    parser.add_argument('--universe',default='zacks_list.csv',help="csv with Ticker and Company Name columns")
+    parser.add_argument('--start',default=None,help="first signal date, YYYY-MM-DD, defaults to a year ago")
+    parser.add_argument('--end',default=None,help="last session date, YYYY-MM-DD, defaults to today")
+    parser.add_argument('--days',type=int,default=120,help="days of daily candles each signal is scored on")
+    parser.add_argument('--trade-limit',type=float,default=150,help="money put into each trade")
+    parser.add_argument('--workers',type=int,default=None,help="worker processes, defaults to settings.scan_workers")
+    parser.add_argument('--db',default='qtrader.db',help="database holding the candles table")
+    parser.add_argument('--output',default=None,help="csv for the per-trade results")
+    args = parser.parse_args(argv)
+    end = datetime.fromisoformat(args.end) if args.end else datetime.now()
+    start = datetime.fromisoformat(args.start) if args.start else end - timedelta(days=365)
+    tickers = [ticker for ticker, name in load_universe(args.universe)]
+    def progress(done,total):
+        if done % 100 == 0 or done == total:
+            print("Backtested",done,"of",total,"tickers")
+    trades = run_backtest(tickers,start,end,args.days,args.trade_limit,args.workers,args.db,progress)
+    print("Trades written to",export_trades(trades,args.output))
+    for key, value in summarize(trades).items():
+        print(key,":",value)
+
+if __name__=="__main__":
+    main()
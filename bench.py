@@ -0,0 +1,316 @@
+#!/bin/env python3
+import os
+import json
+import time
+import sqlite3
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import numpy as np
+import pandas as pd
+import providers
+import marketdata
+import scanner
+from datetime import date, datetime, timedelta
+from charts import chart_columns
+from contracts import ContractCache
+from db import DbWriter, migrate
+from marketdata import CandleStore, QuoteCache
+from orders import OrderManager
+from triggers import TriggerBook
+
+# Offline timings for the scan and trigger hot paths on seeded synthetic
+# candles or candles replayed from a qtrader.db, with the market data
+# provider and IB replaced by the stubs below. Results can be saved as a
+# baseline and later runs compared against it.
+
+def synthetic_candles(tickers=200,bars=250,seed=42,end=None):
+    # a random walk per ticker on business days up to end, indexed by
+    # (symbol,date) like CandleStore.load returns it
+    rng = np.random.default_rng(seed)
+    dates = [stamp.date() for stamp in pd.bdate_range(end=end or date.today(),periods=bars)]
+    dataset = {}
+    for i in range(tickers):
+        ticker = 'T' + str(i).zfill(4)
+        closes = 20 * np.exp(np.cumsum(rng.normal(0,0.02,bars)))
+        opens = np.concatenate(([closes[0]],closes[:-1])) * (1 + rng.normal(0,0.005,bars))
+        highs = np.maximum(opens,closes) * (1 + np.abs(rng.normal(0,0.01,bars)))
+        lows = np.minimum(opens,closes) * (1 - np.abs(rng.normal(0,0.01,bars)))
+        volume = rng.integers(10000,1000000,bars).astype(float)
+        frame = pd.DataFrame({'open':opens,'high':highs,'low':lows,'close':closes,'volume':volume,'adjclose':closes})
+        frame.index = pd.MultiIndex.from_arrays([[ticker]*bars,dates],names=['symbol','date'])
+        dataset[ticker] = frame
+    return dataset
+
+def recorded_candles(path,tickers=200,bars=250):
+    # the last bars daily candles of the first tickers stored in path
+    store = CandleStore(path)
+    names = [row[0] for row in store.connect().execute("select distinct ticker from candles where interval='1d' order by ticker limit :limit",{'limit':tickers})]
+    dataset = {}
+    for ticker, frame in store.load(names,datetime(1970,1,1),datetime.now(),'1d').items():
+        if len(frame.index) > 5:
+            dataset[ticker] = frame.iloc[-bars:]
+    return dataset
+
+class StubProvider:
+    # a market data provider answering from dataset, daily bars only
+    def __init__(self,dataset):
+        self.dataset = dataset
+
+    def history(self,tickers,start,end,interval='1d',timeout=None):
+        frames = {}
+        for ticker in tickers:
+            frame = self.dataset.get(ticker)
+            if frame is None:
+                continue
+            dates = frame.index.get_level_values(-1)
+            frames[ticker] = frame[(dates >= pd.Timestamp(start).date()) & (dates <= pd.Timestamp(end).date())]
+        return frames
+
+    def intraday(self,tickers,start,end,interval='5m',timeout=None):
+        return {}
+
+    def quotes(self,tickers,timeout=None):
+        return {ticker:float(self.dataset[ticker]['close'].iloc[-1]) for ticker in tickers if ticker in self.dataset}
+
+    def summary(self,tickers,timeout=None):
+        return {ticker:{'volume':float(self.dataset[ticker]['volume'].iloc[-1])} for ticker in tickers if ticker in self.dataset}
+
+class StubEvent:
+    def __init__(self):
+        self.handlers = []
+
+    def __iadd__(self,handler):
+        self.handlers.append(handler)
+        return self
+
+class StubTrade:
+    def __init__(self,order):
+        self.order = order
+        self.statusEvent = StubEvent()
+        self.fillEvent = StubEvent()
+
+class StubIB:
+    # placeOrder only, orders are numbered and never reported on
+    def __init__(self):
+        self.next_id = 0
+
+    def placeOrder(self,contract,order):
+        self.next_id += 1
+        order.orderId = self.next_id
+        return StubTrade(order)
+
+@contextlib.contextmanager
+def stubbed(dataset,path):
+    # every role served by StubProvider and the scan pointed at a candle
+    # store and quote cache of its own, everything is put back afterwards
+    saved = (dict(providers.overrides),scanner.candle_store,scanner.quote_cache)
+    providers.register('stub',StubProvider(dataset))
+    providers.use_provider('stub')
+    scanner.candle_store = CandleStore(path,refresh=1e-9)
+    scanner.quote_cache = QuoteCache(ttl=1e-9)
+    try:
+        yield
+    finally:
+        overrides, scanner.candle_store, scanner.quote_cache = saved
+        providers.overrides.clear()
+        providers.overrides.update(overrides)
+
+def bars_in(dataset):
+    return sum(len(frame.index) for frame in dataset.values())
+
+def bench_find_levels(dataset,workdir):
+    def run():
+        for candles in dataset.values():
+            scanner.find_levels(candles)
+    return run,len(dataset),bars_in(dataset)
+
+def bench_score_steps(dataset,workdir):
+    def run():
+        for candles in dataset.values():
+            scanner.score_steps(candles)
+    return run,len(dataset),bars_in(dataset)
+
+def bench_bar_scores(dataset,workdir):
+    arrays = [scanner.candle_arrays(candles) for candles in dataset.values()]
+    def run():
+        for opens, highs, lows, closes in arrays:
+            scanner.bar_scores(opens,highs,lows,closes)
+    return run,len(dataset),bars_in(dataset)
+
+def bench_candle_scorers(dataset,workdir):
+    # the per-candle red_candle and clean_*_movement functions
+    rows = [candles.to_dict('records') for candles in dataset.values()]
+    def run():
+        for candles in rows:
+            for first, second in zip(candles,candles[1:]):
+                scanner.red_candle(second)
+                scanner.clean_bear_movement(first,second)
+                scanner.clean_bull_movement(first,second)
+    return run,len(dataset),bars_in(dataset)
+
+def bench_update_chart(dataset,workdir):
+    # what BuyWindow computes from the candles once they arrive, the chart
+    # columns for show_candles and buy_levels for show_levels
+    def run():
+        for candles in dataset.values():
+            chart_columns(candles)
+            scanner.buy_levels(candles,float(candles['close'].iloc[-1]))
+    return run,len(dataset),bars_in(dataset)
+
+def bench_scan_chunk(dataset,workdir):
+    # scan_chunk end to end against the stub provider, the candle
+    # store saves and reloads every chunk as it would after candle_refresh
+    path = os.path.join(workdir,'scan.db')
+    migrate(sqlite3.connect(path))
+    universe = [(ticker,ticker) for ticker in dataset]
+    end_date = datetime.now()
+    start_date = end_date - timedelta(days=120)
+    def run():
+        with stubbed(dataset,path):
+            for chunk in marketdata.chunked(universe,50):
+                scanner.scan_chunk(chunk,start_date,end_date,scanner.StageClock())
+    return run,len(dataset),bars_in(dataset)
+
+def bench_checkprice(dataset,workdir,rounds=20,seed=42):
+    # checkprice for every ticker as an open position: prices through a
+    # QuoteCache, then OrderManager.check_triggers as the GUI calls it, on a
+    # stub IB with every contract already in the ContractCache
+    path = os.path.join(workdir,'triggers.db')
+    con = sqlite3.connect(path)
+    migrate(con)
+    writer = DbWriter(path)
+    book = TriggerBook(con,writer=writer)
+    ib_conn = StubIB()
+    contracts = ContractCache(ib_conn,con,writer=writer)
+    fetched_at = datetime.now().isoformat()
+    contracts.contracts = {ticker:{'conid':i+1,'min_tick':0.01,'dps':2,'fetched_at':fetched_at} for i, ticker in enumerate(dataset)}
+    manager = OrderManager(ib_conn,con,book,contracts,writer=writer)
+    trade_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for ticker, candles in dataset.items():
+        price = float(candles['close'].iloc[-1])
+        book.add(trade_date,ticker,'Active','Below',price*0.97)
+        book.add(trade_date,ticker,'Active','Above',price*1.03)
+        book.add(trade_date,ticker,'Active','Above',price*1.06)
+    writer.flush()
+    rng = np.random.default_rng(seed)
+    tickers = list(dataset)
+    quotes_by_round = []
+    for i in range(rounds):
+        moved = {ticker:pd.DataFrame({'close':[float(candles['close'].iloc[-1]) * (1 + rng.normal(0,0.02))]}) for ticker, candles in dataset.items()}
+        quotes_by_round.append(QuoteCache(ttl=1e-9,provider=StubProvider(moved)))
+    def run():
+        book.load()
+        for quotes in quotes_by_round:
+            prices = quotes.get_many(tickers)
+            for ticker in tickers:
+                manager.check_triggers(ticker,100,prices[ticker])
+        writer.flush()
+        # put every trigger back for the next repeat
+        writer.execute("update trigger set status='Active',close_date=null")
+        writer.flush()
+        manager.orders.clear()
+        manager.rearmed.clear()
+    return run,len(tickers)*rounds,0
+
+BENCHES = {
+    'find_levels':bench_find_levels,
+    'score_steps':bench_score_steps,
+    'bar_scores':bench_bar_scores,
+    'candle_scorers':bench_candle_scorers,
+    'update_chart':bench_update_chart,
+    'scan_chunk':bench_scan_chunk,
+    'checkprice':bench_checkprice,
+}
+
+def measure(run,repeat=3):
+    # best wall time of repeat runs, then one more run under tracemalloc for
+    # the peak, print output is discarded so it does not swamp the report
+    best = None
+    with open(os.devnull,'w') as devnull, contextlib.redirect_stdout(devnull):
+        for i in range(repeat):
+            started = time.perf_counter()
+            run()
+            took = time.perf_counter() - started
+            best = took if best is None else min(best,took)
+        tracemalloc.start()
+        try:
+            run()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return best,peak
+
+def run_benches(dataset,names=None,repeat=3):
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in names or BENCHES:
+            run, tickers, bars = BENCHES[name](dataset,workdir)
+            seconds, peak = measure(run,repeat)
+            results[name] = {
+                'seconds':seconds,
+                'tickers_per_sec':tickers / seconds if seconds else None,
+                'bars_per_sec':bars / seconds if bars and seconds else None,
+                'peak_kib':peak / 1024,
+            }
+            print(name,":",round(seconds,4),"s,",round(results[name]['tickers_per_sec'] or 0,1),"tickers/s,",
+                round(results[name]['bars_per_sec'] or 0,1),"bars/s,",round(results[name]['peak_kib'],1),"KiB peak")
+    return results
+
+def compare(results,baseline,tolerance=0.2):
+    # names of the benches whose throughput fell or peak memory grew by more
+    # than tolerance against baseline
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if base['tickers_per_sec'] and result['tickers_per_sec'] < base['tickers_per_sec'] * (1 - tolerance):
+            regressions.append(name + " throughput " + str(round(result['tickers_per_sec'],1)) + " tickers/s, baseline " + str(round(base['tickers_per_sec'],1)))
+        if base['peak_kib'] and result['peak_kib'] > base['peak_kib'] * (1 + tolerance):
+            regressions.append(name + " peak memory " + str(round(result['peak_kib'],1)) + " KiB, baseline " + str(round(base['peak_kib'],1)))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the scan and trigger hot paths offline")
+    parser.add_argument('--tickers',type=int,default=200,help="tickers in the dataset")
+    parser.add_argument('--bars',type=int,default=250,help="daily bars per ticker")
+    parser.add_argument('--seed',type=int,default=42,help="seed for the synthetic candles")
+    parser.add_argument('--replay',default=None,help="read candles from this database instead of generating them")
+    parser.add_argument('--bench',action='append',choices=list(BENCHES),help="run only these benches, can be repeated")
+    parser.add_argument('--repeat',type=int,default=3,help="timed runs per bench, the best one is kept")
+    parser.add_argument('--baseline',default='bench_baseline.json',help="json file to compare against")
+    parser.add_argument('--save',action='store_true',help="write the results as the new baseline")
+    parser.add_argument('--tolerance',type=float,default=0.2,help="allowed slowdown or memory growth before a bench is flagged")
+    args = parser.parse_args(argv)
+    if args.replay:
+        dataset = recorded_candles(args.replay,args.tickers,args.bars)
+        source = 'replay:' + args.replay
+    else:
+        dataset = synthetic_candles(args.tickers,args.bars,args.seed)
+        source = 'synthetic'
+    meta = {'source':source,'tickers':len(dataset),'bars':bars_in(dataset),'seed':args.seed}
+    print("Benchmarking",meta['tickers'],"tickers,",meta['bars'],"bars from",source)
+    results = run_benches(dataset,args.bench,args.repeat)
+    if args.save:
+        with open(args.baseline,'w') as baseline_file:
+            json.dump({'meta':meta,'created':datetime.now().strftime("%Y-%m-%d %H:%M:%S"),'results':results},baseline_file,indent=2)
+        print("Baseline written to",args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print("No baseline at",args.baseline,", run with --save to create one")
+        return 0
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline.get('meta') != meta:
+        print("Baseline was taken on",baseline.get('meta'),", comparing anyway")
+    regressions = compare(results,baseline['results'],args.tolerance)
+    for regression in regressions:
+        print("REGRESSION",regression)
+    if not regressions:
+        print("No regressions against",args.baseline)
+    return 1 if regressions else 0
+
+if __name__=="__main__":
+    raise SystemExit(main())
@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+from dateutil.tz import tzlocal
+
+def chart_columns(candles):
+    # the columns BuyWindow draws as plain lists, with bar times as epoch
+    # milliseconds the way QDateTime(timestamp).toMSecsSinceEpoch() gives
+    # them, naive daily dates being local time
+    stamps = pd.DatetimeIndex(pd.to_datetime(candles.index.get_level_values(-1)))
+    if stamps.tz is None:
+        stamps = stamps.tz_localize(tzlocal(),ambiguous='NaT',nonexistent='shift_forward')
+    columns = {
+        'time':((stamps - pd.Timestamp(0,tz='UTC')) // pd.Timedelta(milliseconds=1)).tolist(),
+    }
+    for column in ('open','high','low','close','volume'):
+        columns[column] = candles[column].to_numpy(dtype=float).tolist()
+    return columns
+
+def stop_below(lows,price):
+    # low of the latest bar before the last one that is not above price,
+    # skipping the first bar, or the last bar's low when there is none
+    lows = np.asarray(lows,dtype=float)
+    below = np.flatnonzero(lows[1:-1] <= price)
+    if below.size:
+        return lows[1:-1][below[-1]]
+    return lows[-1]
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import ib_insync as ib
+import settings
+from datetime import datetime
+from decimal import Decimal
+from db import writer
+
+log = logging.getLogger(__name__)
+
+def tick_decimals(min_tick):
+    # decimal places of the tick size, 0.01 -> 2, 0.0001 -> 4, 1 -> 0
+    return max(-Decimal(str(min_tick)).normalize().as_tuple().exponent,0)
+
+class ContractCache:
+    # conId, minTick and price precision per ticker kept in memory and in
+    # the contracts table, so placing an order needs no contract details
+    # round trip unless the ticker has never been seen before
+    def __init__(self,ib_conn,con,refresh=None,writer=writer):
+        self.ib = ib_conn
+        self.con = con
+        self.writer = writer
+        self.refresh = refresh or getattr(settings,'contract_refresh',86400)
+        self.contracts = {}
+
+    def load(self):
+        self.contracts = {}
+        for ticker, conid, min_tick, dps, fetched_at in self.con.execute("select ticker,conid,min_tick,dps,fetched_at from contracts"):
+            self.contracts[ticker] = {'conid':conid,'min_tick':min_tick,'dps':dps,'fetched_at':fetched_at}
+
+    def stale(self,tickers):
+        now = datetime.now()
+        stale = []
+        for ticker in tickers:
+            contract = self.contracts.get(ticker)
+            if contract is None or (now - datetime.fromisoformat(contract['fetched_at'])).total_seconds() >= self.refresh:
+                if ticker not in stale:
+                    stale.append(ticker)
+        return stale
+
+    def save(self,ticker,details):
+        contract = {
+            'conid':details.contract.conId,
+            'min_tick':details.minTick,
+            'dps':tick_decimals(details.minTick),
+            'fetched_at':datetime.now().isoformat()
+        }
+        self.writer.execute("insert or replace into contracts(ticker,conid,min_tick,dps,fetched_at) values (:ticker,:conid,:min_tick,:dps,:fetched_at)",
+            dict(contract,ticker=ticker))
+        self.contracts[ticker] = contract
+        return contract
+
+    def get(self,ticker):
+        contract = self.contracts.get(ticker)
+        if contract is None:
+            details = self.ib.reqContractDetails(ib.Stock(ticker,'SMART','USD'))
+            if not details:
+                raise ValueError("No contract details for " + ticker)
+            contract = self.save(ticker,details[0])
+        return contract
+
+    def stock(self,ticker):
+        contract = self.contracts.get(ticker)
+        if contract:
+            return ib.Stock(ticker,'SMART','USD',conId=contract['conid'])
+        return ib.Stock(ticker,'SMART','USD')
+
+    def offset_price(self,ticker,price,ticks=2):
+        contract = self.get(ticker)
+        return round(price + contract['min_tick'] * ticks,contract['dps'])
+
+    def prefetch(self,tickers):
+        # schedules a fetch of every missing or expired ticker on the IB event
+        # loop and returns straight away
+        stale = self.stale(tickers)
+        if not stale or not self.ib.isConnected():
+            return None
+        return ib.util.getLoop().create_task(self.fetch(stale))
+
+    async def fetch(self,tickers):
+        results = await asyncio.gather(*[self.ib.reqContractDetailsAsync(ib.Stock(ticker,'SMART','USD')) for ticker in tickers],return_exceptions=True)
+        for ticker, details in zip(tickers,results):
+            if isinstance(details,Exception) or not details:
+                log.warning("No contract details for %s: %s",ticker,details)
+                continue
+            self.save(ticker,details[0])
+        log.info("Fetched contract details for %s tickers",len(tickers))
@@ -0,0 +1,187 @@
+import time
+import queue
+import atexit
+import logging
+import sqlite3
+import threading
+import settings
+from concurrent.futures import Future
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+con = sqlite3.connect("qtrader.db")
+
+def connect():
+    # for threads other than the one that imported this module
+    return sqlite3.connect("qtrader.db",timeout=30)
+
+class DbWriter:
+    # one thread owns the only connection that writes, statements from any
+    # thread are queued and committed together once batch_size of them are
+    # waiting or interval seconds after the first one, whichever comes first
+    def __init__(self,path="qtrader.db",batch_size=None,interval=None):
+        self.path = path
+        self.batch_size = batch_size or getattr(settings,'db_batch_size',500)
+        self.interval = interval or getattr(settings,'db_flush_interval',1)
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run,name='DbWriter',daemon=True)
+                self.thread.start()
+
+    def execute(self,sql,params=()):
+        # returns a Future for the statement's lastrowid, set as soon as the
+        # statement has run, before it is committed
+        return self.submit(sql,params,False)
+
+    def executemany(self,sql,seq):
+        return self.submit(sql,list(seq),True)
+
+    def submit(self,sql,params,many):
+        self.start()
+        future = Future()
+        self.queue.put((sql,params,many,future))
+        return future
+
+    def flush(self,timeout=None):
+        # blocks until everything queued before the call is committed
+        self.start()
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def run(self):
+        con = sqlite3.connect(self.path,timeout=30)
+        pending = 0
+        deadline = None
+        waiting = []
+        while True:
+            timeout = max(deadline - time.monotonic(),0) if pending else None
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+            if isinstance(item,tuple):
+                sql, params, many, future = item
+                try:
+                    cursor = con.executemany(sql,params) if many else con.execute(sql,params)
+                    future.set_result(cursor.lastrowid)
+                except Exception as exp:
+                    metrics.error('db.write',exp)
+                    log.error("Write failed: %s %s",sql,exp)
+                    future.set_exception(exp)
+                if not pending:
+                    deadline = time.monotonic() + self.interval
+                pending += 1
+                if pending < self.batch_size:
+                    continue
+            elif isinstance(item,threading.Event):
+                waiting.append(item)
+            if pending:
+                try:
+                    with metrics.timer('db.commit'):
+                        con.commit()
+                    metrics.count('db.statements',pending)
+                    pending = 0
+                except sqlite3.OperationalError as exp:
+                    # keep the transaction open and try again on the next round
+                    metrics.error('db.commit',exp)
+                    log.warning("Commit failed: %s",exp)
+                    deadline = time.monotonic() + self.interval
+            if not pending:
+                for done in waiting:
+                    done.set()
+                waiting = []
+            if item is None:
+                break
+        con.close()
+
+writer = DbWriter()
+atexit.register(writer.close)
+
+def baseline(cursor):
+    # the schema update_table used to build before migrations were versioned,
+    # every statement is safe to run against a database that already has it
+    cursor.execute("create table if not exists trades(trade_id INTEGER PRIMARY KEY,trade_date,ticker,setup,buy_price,sell_price,amount,stop_loss,r1,r2,total,status,pnl,close_date)")
+    cursor.execute("create table if not exists trigger(trigger_id INTEGER PRIMARY KEY,trade_date,ticker,status,trigger_type,price,pnl,close_date)")
+    cursor.execute("create table if not exists stocks(stocks_id INTEGER PRIMARY KEY,name,ticker,price,bear_score,vol_score,bounce_score,bear_steps,bounce_steps,pullbackswallow,opt_size,volume,tradecount)")
+    cursor.execute("create table if not exists candles(ticker,interval,date,open,high,low,close,volume,adjclose,PRIMARY KEY(ticker,interval,date))")
+    cursor.execute("create table if not exists candle_fetch(ticker,interval,covered_from,fetched_at,PRIMARY KEY(ticker,interval))")
+    cursor.execute("create table if not exists scan_runs(run_id INTEGER PRIMARY KEY,started,finished,status)")
+    cursor.execute("create table if not exists scan_checkpoint(run_id,ticker,scanned_at,PRIMARY KEY(run_id,ticker))")
+    cursor.execute("create table if not exists contracts(ticker PRIMARY KEY,conid,min_tick,dps,fetched_at)")
+    columns = [column[1] for column in cursor.execute("pragma table_info(stocks)")]
+    if 'scanned_at' not in columns:
+        cursor.execute("alter table stocks add column scanned_at")
+    cursor.execute("delete from stocks where stocks_id not in (select max(stocks_id) from stocks group by ticker)")
+    cursor.execute("create unique index if not exists stocks_ticker on stocks(ticker)")
+
+def rebuild(cursor,table,schema):
+    # sqlite cannot change column types in place, so copy into a new table
+    # with the same column names and let type affinity convert the values
+    columns = ",".join(column[1] for column in cursor.execute("pragma table_info(" + table + ")"))
+    cursor.execute("create table " + table + "_new(" + schema + ")")
+    cursor.execute("insert into " + table + "_new(" + columns + ") select " + columns + " from " + table)
+    cursor.execute("drop table " + table)
+    cursor.execute("alter table " + table + "_new rename to " + table)
+
+def typed_tables(cursor):
+    rebuild(cursor,'trades',"trade_id INTEGER PRIMARY KEY,trade_date TEXT,ticker TEXT,setup TEXT,buy_price REAL,sell_price REAL,amount INTEGER,stop_loss REAL,r1 REAL,r2 REAL,total REAL,status TEXT,pnl REAL,close_date TEXT")
+    rebuild(cursor,'trigger',"trigger_id INTEGER PRIMARY KEY,trade_date TEXT,ticker TEXT,status TEXT,trigger_type TEXT,price REAL,pnl REAL,close_date TEXT")
+    rebuild(cursor,'stocks',"stocks_id INTEGER PRIMARY KEY,name TEXT,ticker TEXT,price REAL,bear_score REAL,vol_score REAL,bounce_score REAL,bear_steps INTEGER,bounce_steps INTEGER,pullbackswallow INTEGER,opt_size REAL,volume INTEGER,tradecount INTEGER,scanned_at TEXT")
+    cursor.execute("create unique index stocks_ticker on stocks(ticker)")
+    # TradeListWindow.checkprice and OrderManager look up open trades per ticker
+    cursor.execute("create index trades_ticker_status on trades(ticker,status)")
+    cursor.execute("create index trades_date on trades(trade_date,ticker)")
+    # TriggerBook.load and cancel_ticker, then TriggerListTable.update_list
+    cursor.execute("create index trigger_status on trigger(status,ticker,trigger_type,price)")
+    cursor.execute("create index trigger_ticker_date on trigger(ticker,trade_date)")
+    cursor.execute("create index trigger_date on trigger(trade_date)")
+    # only the shortlist rows, in the order SHORTLIST_QUERY reads them
+    cursor.execute("create index stocks_shortlist on stocks(tradecount desc,volume desc,opt_size desc,bear_steps desc,bear_score desc,vol_score desc,bounce_steps desc,bounce_score desc) where bear_steps > 0 and bounce_steps > 0")
+    cursor.execute("create index scan_checkpoint_scanned on scan_checkpoint(scanned_at)")
+
+def news_tables(cursor):
+    cursor.execute("create table news(ticker TEXT,time_published TEXT,title TEXT,url TEXT,summary TEXT,source TEXT,PRIMARY KEY(ticker,time_published,url))")
+    cursor.execute("create table news_fetch(ticker TEXT PRIMARY KEY,fetched_at TEXT)")
+
+# append new steps at the end, the position in this list is the schema
+# version stored in pragma user_version once the step has run
+MIGRATIONS = [
+    baseline,
+    typed_tables,
+    news_tables,
+]
+
+def migrate(con):
+    version = con.execute("pragma user_version").fetchone()[0]
+    for number, step in enumerate(MIGRATIONS,1):
+        if number <= version:
+            continue
+        cursor = con.cursor()
+        try:
+            cursor.execute("begin")
+            step(cursor)
+            cursor.execute("pragma user_version=" + str(number))
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        finally:
+            cursor.close()
+        log.info("Migrated %s to schema version %s",con.execute("pragma database_list").fetchone()[2] or ':memory:',number)
+
+def update_table():
+    # WAL lets the scan and GUI connections read while another one writes
+    con.execute("pragma journal_mode=wal")
+    migrate(con)
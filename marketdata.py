@@ -0,0 +1,224 @@
+import math
+import time
+import logging
+import sqlite3
+import threading
+import pandas as pd
+import settings
+from collections import OrderedDict
+from datetime import datetime, timezone
+from metrics import metrics
+from providers import candle_key, date_key, candle_frame, provider_for
+
+log = logging.getLogger(__name__)
+
+def latest_price(ticker):
+    return quote_cache.get(ticker)
+
+def chunked(items,size):
+    items = list(items)
+    for i in range(0,len(items),size):
+        yield items[i:i+size]
+
+def fetch_history(tickers,start,end,interval='1d',timeout=None,provider=None):
+    provider = provider or provider_for('history' if interval == '1d' else 'intraday')
+    if interval == '1d':
+        return provider.history(tickers,start,end,interval=interval,timeout=timeout)
+    return provider.intraday(tickers,start,end,interval=interval,timeout=timeout)
+
+def fetch_prices(tickers,timeout=None,provider=None):
+    return (provider or provider_for('quote')).quotes(tickers,timeout=timeout)
+
+def fetch_summary(tickers,timeout=None,provider=None):
+    return (provider or provider_for('summary')).summary(tickers,timeout=timeout)
+
+class QuoteCache:
+    def __init__(self,ttl=None,size=None,provider=None):
+        self.ttl = ttl or getattr(settings,'quote_ttl',15)
+        self.provider = provider
+        self.size = size or getattr(settings,'quote_cache_size',2000)
+        self.quotes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self,ticker):
+        return self.get_many([ticker])[ticker]
+
+    def get_many(self,tickers,timeout=None):
+        # None for a symbol whose request failed or that Yahoo left out,
+        # only real prices are cached
+        timeout = timeout or getattr(settings,'quote_timeout',10)
+        now = time.monotonic()
+        prices = {}
+        missing = []
+        with self.lock:
+            for ticker in tickers:
+                quote = self.quotes.get(ticker)
+                if quote and now - quote[1] < self.ttl:
+                    self.quotes.move_to_end(ticker)
+                    prices[ticker] = quote[0]
+                elif ticker not in missing:
+                    missing.append(ticker)
+        if missing:
+            fetched = {}
+            failed = set()
+            for chunk in chunked(missing,getattr(settings,'scan_chunk_size',50)):
+                try:
+                    with metrics.timer('quotes.fetch'):
+                        fetched.update(fetch_prices(chunk,timeout=timeout,provider=self.provider))
+                except Exception as exp:
+                    failed.update(chunk)
+                    metrics.error('quotes',exp)
+                    log.warning("Can't get prices for: %s %s",chunk,exp)
+            now = time.monotonic()
+            with self.lock:
+                for ticker in missing:
+                    price = fetched.get(ticker)
+                    if ticker in failed or price is None or not price > 0:
+                        prices[ticker] = None
+                        continue
+                    prices[ticker] = price
+                    self.quotes[ticker] = (price,now)
+                    self.quotes.move_to_end(ticker)
+                while len(self.quotes) > self.size:
+                    self.quotes.popitem(last=False)
+        return prices
+
+    def invalidate(self,ticker=None):
+        with self.lock:
+            if ticker:
+                self.quotes.pop(ticker,None)
+            else:
+                self.quotes.clear()
+
+quote_cache = QuoteCache()
+
+class CandleStore:
+    columns = ['open','high','low','close','volume','adjclose']
+
+    def __init__(self,path='qtrader.db',refresh=None,provider=None):
+        self.path = path
+        self.refresh = refresh or getattr(settings,'candle_refresh',900)
+        self.provider = provider
+        self.local = threading.local()
+
+    def connect(self):
+        con = getattr(self.local,'con',None)
+        if con is None:
+            con = sqlite3.connect(self.path,timeout=30)
+            self.local.con = con
+        return con
+
+    def stale(self,tickers,start,interval):
+        # returns {fetch_from: [tickers]} for every ticker whose stored bars
+        # do not cover start or have not been topped up recently. A split or
+        # dividend is caught by changed() on the overlap bar, which then has
+        # the whole window fetched again.
+        con = self.connect()
+        now = datetime.now()
+        groups = {}
+        for ticker in tickers:
+            meta = con.execute("select covered_from,fetched_at from candle_fetch where ticker=:ticker and interval=:interval",
+                {'ticker':ticker,'interval':interval}).fetchone()
+            fetch_from = start
+            if meta and meta[0]<=date_key(start,interval):
+                fetched_at = datetime.fromisoformat(meta[1])
+                if (now - fetched_at).total_seconds() < self.refresh:
+                    continue
+                overlap = self.overlap(ticker,interval)
+                if overlap:
+                    # from the bar before the last one, the last may have been
+                    # partial and the one before is compared by changed()
+                    last = pd.Timestamp(overlap[0]).to_pydatetime()
+                    if interval != '1d':
+                        last = last.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+                    fetch_from = max(start,last)
+            groups.setdefault(fetch_from,[]).append(ticker)
+        return groups
+
+    def overlap(self,ticker,interval):
+        # (date,close,adjclose) of the stored bar before the last one, or the
+        # last one when only one is stored
+        rows = self.connect().execute("select date,close,adjclose from candles where ticker=:ticker and interval=:interval order by date desc limit 2",
+            {'ticker':ticker,'interval':interval}).fetchall()
+        return rows[-1] if rows else None
+
+    def changed(self,frames,interval):
+        # tickers whose fetched overlap bar no longer matches the stored one.
+        # After a split or dividend every stored bar is on the old basis, so
+        # those get the whole window fetched again and replace what is stored.
+        changed = []
+        for ticker, frame in frames.items():
+            overlap = self.overlap(ticker,interval)
+            if overlap is None:
+                continue
+            keys = [candle_key(key,interval) for key in frame.index.get_level_values(-1)]
+            if overlap[0] not in keys:
+                continue
+            bar = frame.iloc[keys.index(overlap[0])]
+            for column, stored in zip(('close','adjclose'),overlap[1:]):
+                fetched = bar.get(column)
+                if stored is None or fetched is None or pd.isna(fetched):
+                    continue
+                if not math.isclose(float(fetched),stored,rel_tol=1e-4):
+                    changed.append(ticker)
+                    break
+        return changed
+
+    def save(self,frames,start,interval,replace=()):
+        # candle_fetch is only written for tickers that came back with bars,
+        # the rest stay stale and are asked for again. Tickers in replace lose
+        # every stored bar first and are covered from start only.
+        con = self.connect()
+        for ticker in replace:
+            con.execute("delete from candles where ticker=:ticker and interval=:interval",{'ticker':ticker,'interval':interval})
+        rows = []
+        for ticker, frame in frames.items():
+            values = frame.reindex(columns=self.columns)
+            for key, bar in zip(frame.index.get_level_values(-1),values.itertuples(index=False)):
+                rows.append((ticker,interval,candle_key(key,interval)) + tuple(None if pd.isna(x) else float(x) for x in bar))
+        con.executemany("insert or replace into candles(ticker,interval,date,open,high,low,close,volume,adjclose) values (?,?,?,?,?,?,?,?,?)",rows)
+        fetched_at = datetime.now().isoformat()
+        covered_from = date_key(start,interval)
+        for ticker in frames:
+            if ticker in replace:
+                con.execute("insert or replace into candle_fetch(ticker,interval,covered_from,fetched_at) values (:ticker,:interval,:covered_from,:fetched_at)",
+                    {'ticker':ticker,'interval':interval,'covered_from':covered_from,'fetched_at':fetched_at})
+            else:
+                con.execute("insert into candle_fetch(ticker,interval,covered_from,fetched_at) values (:ticker,:interval,:covered_from,:fetched_at) on conflict(ticker,interval) do update set covered_from=min(covered_from,excluded.covered_from),fetched_at=excluded.fetched_at",
+                    {'ticker':ticker,'interval':interval,'covered_from':covered_from,'fetched_at':fetched_at})
+        con.commit()
+
+    def load(self,tickers,start,end,interval):
+        con = self.connect()
+        frames = {}
+        for ticker in tickers:
+            rows = con.execute("select date,open,high,low,close,volume,adjclose from candles where ticker=:ticker and interval=:interval and date>=:start and date<=:end order by date",
+                {'ticker':ticker,'interval':interval,'start':date_key(start,interval),'end':date_key(end,interval)}).fetchall()
+            if not rows:
+                continue
+            frames[ticker] = candle_frame(ticker,rows,interval)
+        return frames
+
+    def history(self,tickers,start,end,interval='1d',timeout=None,provider=None):
+        # provider, or the store's own, replaces the one settings pick for this call
+        tickers = list(tickers)
+        provider = provider or self.provider
+        for fetch_from, group in self.stale(tickers,start,interval).items():
+            with metrics.timer('candles.fetch.' + interval):
+                frames = fetch_history(group,fetch_from,end,interval=interval,timeout=timeout,provider=provider)
+            refetched = {}
+            changed = self.changed(frames,interval) if fetch_from != start else []
+            if changed:
+                log.info("Stored bars changed for %s, fetching the whole window again",changed)
+                metrics.count('candles.refetch',len(changed))
+                with metrics.timer('candles.fetch.' + interval):
+                    refetched = fetch_history(changed,start,end,interval=interval,timeout=timeout,provider=provider)
+                # a top-up on the old basis is not saved, the ticker stays stale
+                for ticker in changed:
+                    frames.pop(ticker,None)
+                frames.update(refetched)
+            with metrics.timer('candles.save'):
+                self.save(frames,start,interval,replace=list(refetched))
+        return self.load(tickers,start,end,interval)
+
+candle_store = CandleStore()
@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+import settings
+from contextlib import contextmanager
+from datetime import datetime
+
+# upper bounds in seconds of the latency histogram buckets, anything slower
+# goes in the last one
+BUCKETS = (0.001,0.005,0.01,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,120)
+
+class Metrics:
+    # counters, timers with latency histograms and error counts by type, all
+    # kept in memory and written out as json by export. Every update is a
+    # few dict operations under one lock, cheap enough for the scan loops.
+    def __init__(self,path=None,buckets=BUCKETS):
+        self.path = path or getattr(settings,'metrics_path','metrics.json')
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = datetime.now()
+            self.counters = {}
+            self.timers = {}
+            self.errors = {}
+
+    def count(self,name,amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name,0) + amount
+
+    def observe(self,name,seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = {'count':0,'total':0.0,'max':0.0,'histogram':[0]*(len(self.buckets)+1)}
+            timer['count'] += 1
+            timer['total'] += seconds
+            timer['max'] = max(timer['max'],seconds)
+            timer['histogram'][bisect.bisect_left(self.buckets,seconds)] += 1
+
+    @contextmanager
+    def timer(self,name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name,time.perf_counter() - started)
+
+    def error(self,stage,exp):
+        # counted per stage and exception class, e.g. quotes/TimeoutError
+        with self.lock:
+            errors = self.errors.setdefault(stage,{})
+            name = type(exp).__name__
+            errors[name] = errors.get(name,0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            timers = {}
+            for name, timer in self.timers.items():
+                timers[name] = {
+                    'count':timer['count'],
+                    'total':timer['total'],
+                    'mean':timer['total'] / timer['count'],
+                    'max':timer['max'],
+                    'histogram':dict(zip([str(bound) for bound in self.buckets] + ['inf'],timer['histogram'])),
+                }
+            return {
+                'started':self.started.strftime("%Y-%m-%d %H:%M:%S"),
+                'exported':datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                'counters':dict(self.counters),
+                'timers':timers,
+                'errors':{stage:dict(errors) for stage, errors in self.errors.items()},
+            }
+
+    def export(self,path=None):
+        # written to a temporary file first so a reader never sees half of it
+        path = path or self.path
+        with open(path + '.tmp','w') as metrics_file:
+            json.dump(self.snapshot(),metrics_file,indent=2)
+        os.replace(path + '.tmp',path)
+        return path
+
+metrics = Metrics()
+
+def setup_logging(level=None):
+    # modules log through logging.getLogger(__name__), below the level a
+    # call returns before its message is formatted
+    logging.basicConfig(level=level or getattr(settings,'log_level','INFO'),format='%(asctime)s %(levelname)s %(name)s: %(message)s')
@@ -0,0 +1,210 @@
+import logging
+from PySide6.QtCore import Qt, QAbstractTableModel, QSortFilterProxyModel, QModelIndex
+from PySide6.QtWidgets import QStyledItemDelegate, QComboBox
+
+log = logging.getLogger(__name__)
+
+class QueryModel(QAbstractTableModel):
+    # rows of a select read in one go when it is (re)loaded, so no cursor is
+    # left open on the shared connection, and handed to the view batch_size
+    # at a time as it scrolls instead of being inserted up front. Qt.UserRole
+    # returns the raw column value so sorting and filtering compare numbers.
+    batch_size = 256
+
+    def __init__(self,con,query,headers,params=None,key=0):
+        super().__init__()
+        self.con = con
+        self.query = query
+        self.params = params or {}
+        self.headers = headers
+        self.key = key
+        self.rows = []
+        self.keys = {}
+        self.unread = []
+        self.reload()
+
+    def reload(self,query=None,params=None):
+        self.beginResetModel()
+        if query is not None:
+            self.query = query
+        if params is not None:
+            self.params = params
+        self.rows = []
+        self.keys = {}
+        self.unread = self.con.execute(self.query,self.params).fetchall()
+        self.unread.reverse()
+        self.endResetModel()
+
+    def rowCount(self,parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self,parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def canFetchMore(self,parent=QModelIndex()):
+        return not parent.isValid() and bool(self.unread)
+
+    def fetchMore(self,parent=QModelIndex()):
+        if parent.isValid() or not self.unread:
+            return
+        # unread is kept back to front so a batch comes off its end
+        fetched = self.unread[-self.batch_size:]
+        del self.unread[-self.batch_size:]
+        fetched.reverse()
+        # a row upsert has already shown is newer than the one read at reload
+        batch = [row for row in fetched if row[self.key] not in self.keys]
+        if not batch:
+            return
+        self.beginInsertRows(QModelIndex(),len(self.rows),len(self.rows)+len(batch)-1)
+        for row in batch:
+            self.keys[row[self.key]] = len(self.rows)
+            self.rows.append(list(row))
+        self.endInsertRows()
+
+    def data(self,index,role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        value = self.rows[index.row()][index.column()]
+        if role in (Qt.DisplayRole,Qt.EditRole):
+            return '' if value is None else str(value)
+        if role == Qt.UserRole:
+            return value
+        return None
+
+    def headerData(self,section,orientation,role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.headers[section]
+        return None
+
+    def key_at(self,row):
+        return self.rows[row][self.key]
+
+    def insert_first(self,row):
+        self.beginInsertRows(QModelIndex(),0,0)
+        self.rows.insert(0,list(row))
+        self.keys = {row[self.key]:pos for pos, row in enumerate(self.rows)}
+        self.endInsertRows()
+
+    def upsert(self,row):
+        key = row[self.key]
+        if key in self.keys:
+            pos = self.keys[key]
+            self.rows[pos] = list(row)
+            self.dataChanged.emit(self.index(pos,0),self.index(pos,len(self.headers)-1))
+        else:
+            pos = len(self.rows)
+            self.beginInsertRows(QModelIndex(),pos,pos)
+            self.keys[key] = pos
+            self.rows.append(list(row))
+            self.endInsertRows()
+
+class TriggerModel(QueryModel):
+    # the trigger table with status, type and price editable in place, an
+    # edit goes straight to trigger_book and changes trigger_book makes
+    # elsewhere, like an order filling, are applied to the row they touch
+    columns = ['trigger_id','trade_date','ticker','status','trigger_type','price','pnl','close_date']
+    editable = ('status','trigger_type','price')
+
+    def __init__(self,con,trigger_book,ticker=None):
+        super().__init__(con,self.select(ticker),['Id','Date','Ticker','Status','Type','Price','P&L','close Date'],self.select_params(ticker))
+        self.trigger_book = trigger_book
+        self.ticker = ticker
+        trigger_book.listen(self.trigger_changed)
+
+    @classmethod
+    def select(cls,ticker=None):
+        query = "select " + ",".join(cls.columns) + " from trigger"
+        if ticker:
+            query += " where ticker=:ticker"
+        return query + " order by trade_date desc"
+
+    @staticmethod
+    def select_params(ticker=None):
+        return {'ticker':ticker} if ticker else {}
+
+    def set_ticker(self,ticker):
+        self.ticker = ticker
+        self.reload(self.select(ticker),self.select_params(ticker))
+
+    def flags(self,index):
+        flags = super().flags(index)
+        if index.isValid() and self.columns[index.column()] in self.editable:
+            flags |= Qt.ItemIsEditable
+        return flags
+
+    def setData(self,index,value,role=Qt.EditRole):
+        if role != Qt.EditRole or not index.isValid():
+            return False
+        row = list(self.rows[index.row()])
+        column = self.columns[index.column()]
+        if column == 'price':
+            try:
+                value = float(value)
+            except ValueError:
+                return False
+        row[index.column()] = value
+        log.debug("Data to update: %s",row)
+        self.trigger_book.update(row[0],row[self.columns.index('price')],row[self.columns.index('status')],row[self.columns.index('trigger_type')])
+        return True
+
+    def trigger_changed(self,trigger_id,fields):
+        if trigger_id in self.keys:
+            pos = self.keys[trigger_id]
+            for column, value in fields.items():
+                self.rows[pos][self.columns.index(column)] = value
+            self.dataChanged.emit(self.index(pos,0),self.index(pos,len(self.columns)-1))
+            return
+        # not scrolled into view yet, the buffered row is brought up to date
+        for pos, row in enumerate(self.unread):
+            if row[self.key] == trigger_id:
+                row = list(row)
+                for column, value in fields.items():
+                    row[self.columns.index(column)] = value
+                self.unread[pos] = tuple(row)
+                return
+        if 'ticker' in fields and (not self.ticker or self.ticker == fields['ticker']):
+            self.insert_first([trigger_id] + [fields.get(column) for column in self.columns[1:]])
+
+class ComboDelegate(QStyledItemDelegate):
+    def __init__(self,items,parent=None):
+        super().__init__(parent)
+        self.items = items
+
+    def createEditor(self,parent,option,index):
+        editor = QComboBox(parent)
+        editor.addItems(self.items)
+        return editor
+
+    def setEditorData(self,editor,index):
+        editor.setCurrentText(index.data(Qt.EditRole))
+
+    def setModelData(self,editor,model,index):
+        model.setData(index,editor.currentText(),Qt.EditRole)
+
+class ThresholdFilter(QSortFilterProxyModel):
+    # sorts on the raw values and hides rows under a minimum per column
+    def __init__(self):
+        super().__init__()
+        self.thresholds = {}
+        self.setSortRole(Qt.UserRole)
+
+    def set_threshold(self,column,minimum):
+        if minimum is None:
+            self.thresholds.pop(column,None)
+        else:
+            self.thresholds[column] = minimum
+        self.invalidateFilter()
+
+    def clear_thresholds(self):
+        self.thresholds = {}
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self,source_row,source_parent):
+        row = self.sourceModel().rows[source_row]
+        for column, minimum in self.thresholds.items():
+            try:
+                if row[column] is None or float(row[column]) < minimum:
+                    return False
+            except (TypeError,ValueError):
+                return False
+        return True
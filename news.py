@@ -0,0 +1,95 @@
+import time
+import logging
+import sqlite3
+import threading
+import requests
+import settings
+from requests.adapters import HTTPAdapter
+from datetime import datetime
+from db import writer
+
+log = logging.getLogger(__name__)
+
+NEWS_URL = 'https://www.alphavantage.co/query'
+
+class TokenBucket:
+    # allows rate requests per second on average with bursts of up to
+    # capacity, acquire blocks until a token is free
+    def __init__(self,rate,capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self,timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None:
+                if now + wait > deadline:
+                    return False
+            time.sleep(wait)
+
+class NewsStore:
+    # Alphavantage news kept in the news table, read from there first and
+    # topped up at most every refresh seconds with only the items published
+    # since the newest one stored
+    def __init__(self,path='qtrader.db',refresh=None,writer=writer):
+        self.path = path
+        self.refresh = refresh or getattr(settings,'news_refresh',1800)
+        self.writer = writer
+        self.local = threading.local()
+        self.bucket = TokenBucket(getattr(settings,'news_per_minute',5) / 60,getattr(settings,'news_burst',5))
+        self.session = requests.Session()
+        self.session.mount('https://',HTTPAdapter(pool_connections=1,pool_maxsize=getattr(settings,'scan_workers',8)))
+
+    def connect(self):
+        con = getattr(self.local,'con',None)
+        if con is None:
+            con = sqlite3.connect(self.path,timeout=30)
+            self.local.con = con
+        return con
+
+    def feed(self,ticker,limit=50):
+        # same shape as the NEWS_SENTIMENT response so callers do not care
+        # where it came from
+        rows = self.connect().execute("select time_published,title,url,summary,source from news where ticker=:ticker order by time_published desc limit :limit",
+            {'ticker':ticker,'limit':limit}).fetchall()
+        return {'feed':[{'time_published':row[0],'title':row[1],'url':row[2],'summary':row[3],'source':row[4]} for row in rows]}
+
+    def stale(self,ticker):
+        fetched = self.connect().execute("select fetched_at from news_fetch where ticker=:ticker",{'ticker':ticker}).fetchone()
+        return fetched is None or (datetime.now() - datetime.fromisoformat(fetched[0])).total_seconds() >= self.refresh
+
+    def update(self,ticker):
+        # returns how many items Alphavantage sent back, None when it was not asked
+        if not self.stale(ticker):
+            return None
+        if not self.bucket.acquire(getattr(settings,'news_timeout',5)):
+            log.warning("News rate limit reached, skipping %s",ticker)
+            return None
+        params = {'function':'NEWS_SENTIMENT','tickers':ticker,'apikey':settings.alphavantage_key,'limit':50}
+        latest = self.connect().execute("select max(time_published) from news where ticker=:ticker",{'ticker':ticker}).fetchone()[0]
+        if latest:
+            # time_from takes minutes, the item at that minute is returned again and ignored on insert
+            params['time_from'] = latest[:13]
+        data = self.session.get(NEWS_URL,params=params,timeout=getattr(settings,'news_timeout',5)).json()
+        if 'feed' not in data:
+            # Alphavantage answers over-limit calls with a Note or Information message
+            log.warning("No news for %s: %s",ticker,data)
+            return None
+        rows = [(ticker,item['time_published'],item['title'],item['url'],item.get('summary'),item.get('source')) for item in data['feed']]
+        self.writer.executemany("insert or ignore into news(ticker,time_published,title,url,summary,source) values (?,?,?,?,?,?)",rows)
+        self.writer.execute("insert or replace into news_fetch(ticker,fetched_at) values (?,?)",(ticker,datetime.now().isoformat()))
+        self.writer.flush()
+        return len(rows)
+
+news_store = NewsStore()
@@ -0,0 +1,199 @@
+import math
+import time
+import logging
+import ib_insync as ib
+from datetime import datetime
+from db import writer
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+ACCEPTED_STATES = ('PreSubmitted','Submitted','Filled')
+WORKING_STATES = ('Submitted','Filled')
+DEAD_STATES = ('Cancelled','ApiCancelled','Inactive')
+
+class OrderManager:
+    # Tracks every order placed through it and reacts to ib_insync trade
+    # events instead of sleeping after placeOrder, so any number of orders
+    # can be in flight. For a trigger sell the trigger goes
+    #   Active -> Submitted (order sent) -> Filled (working or filled at IB)
+    # and back to Active if IB drops the order before anything filled, only
+    # once per trigger so an order IB always rejects is not sent on every
+    # tick. The trade is closed once IB is working the order and reopened
+    # if it dies after all with nothing filled.
+    def __init__(self,ib_conn,con,trigger_book,contract_cache=None,writer=writer):
+        self.ib = ib_conn
+        self.con = con
+        self.writer = writer
+        self.trigger_book = trigger_book
+        self.contract_cache = contract_cache
+        self.orders = {}
+        self.rearmed = set()
+
+    def place(self,contract,order,kind,ticker,price=None,trigger_id=None,close_trade=False):
+        with metrics.timer('orders.place'):
+            trade = self.ib.placeOrder(contract,order)
+        metrics.count('orders.' + kind)
+        record = {
+            'kind':kind,
+            'ticker':ticker,
+            'price':price,
+            'trigger_id':trigger_id,
+            'close_trade':close_trade,
+            'state':'Sent',
+            'accepted':False,
+            'trade_ids':[],
+            'cancelled':[],
+            'filled':0,
+            'sent':time.monotonic()
+        }
+        self.orders[trade.order.orderId] = record
+        trade.statusEvent += self.on_status
+        trade.fillEvent += self.on_fill
+        if trigger_id:
+            self.trigger_book.set_status(trigger_id,'Submitted',now())
+        log.info("Sent %s order %s for %s",kind,trade.order.orderId,ticker)
+        return trade
+
+    def check_triggers(self,ticker,amount,price):
+        # sells for the lowest Above trigger price is over, otherwise for the
+        # highest Below trigger it is under. Orders are handed to place,
+        # which updates the trigger and trades rows as IB reports back, so
+        # nothing here waits on IB
+        if price is None or not price > 0:
+            # a failed quote, no stop may fire on it
+            log.warning("No usable price for %s: %s",ticker,price)
+            return None
+        trigger = self.trigger_book.crossed_above(ticker,price)
+        if trigger:
+            trigger_id, trigger_price, divide = trigger
+            to_sell = math.floor(amount/divide)
+            if to_sell <= 0:
+                # IB rejects a zero quantity order, nothing to sell for this trigger
+                log.debug("Not selling %s of %s for trigger %s",to_sell,ticker,trigger_id)
+                return None
+            log.info("Price %s is higher than trigger %s",price,trigger_price)
+            stock = self.contract_cache.stock(ticker)
+            order = ib.Order()
+            order.action = 'SELL'
+            order.orderType = 'TRAIL'
+            order.totalQuantity = float(to_sell)
+            order.trailingPercent = 0.1
+            order.transmit = True
+            return self.place(stock,order,'trigger',ticker,price=price,trigger_id=trigger_id,close_trade=divide==1)
+        trigger = self.trigger_book.crossed_below(ticker,price)
+        if trigger:
+            trigger_id, trigger_price, divide = trigger
+            to_sell = math.floor(amount/divide)
+            if to_sell <= 0:
+                # IB rejects a zero quantity order, nothing to sell for this trigger
+                log.debug("Not selling %s of %s for trigger %s",to_sell,ticker,trigger_id)
+                return None
+            log.info("Price %s is lower than trigger %s",price,trigger_price)
+            stock = self.contract_cache.stock(ticker)
+            order = ib.Order()
+            order.lmtPrice = price
+            order.orderType = 'MKT'
+            order.transmit = True
+            order.totalQuantity = float(to_sell)
+            order.action = 'SELL'
+            order.lmtPrice = self.contract_cache.offset_price(stock.symbol,order.lmtPrice)
+            return self.place(stock,order,'trigger',ticker,price=price,trigger_id=trigger_id,close_trade=divide==1)
+        return None
+
+    def working(self,ticker,kind=None):
+        for record in self.orders.values():
+            if record['ticker']==ticker and (kind is None or record['kind']==kind):
+                return True
+        return False
+
+    def on_status(self,trade):
+        record = self.orders.get(trade.order.orderId)
+        status = trade.orderStatus.status
+        if record is None or status == record['state']:
+            return
+        log.info("Order %s %s %s %s -> %s",trade.order.orderId,record['kind'],record['ticker'],record['state'],status)
+        record['state'] = status
+        if status in ACCEPTED_STATES and 'acked' not in record:
+            # time from placeOrder until IB first took the order
+            record['acked'] = time.monotonic()
+            metrics.observe('orders.ack',record['acked'] - record['sent'])
+        elif status in DEAD_STATES:
+            metrics.count('orders.dead')
+        if record['kind'] != 'buy':
+            if status in WORKING_STATES:
+                if record['trigger_id']:
+                    self.trigger_book.set_status(record['trigger_id'],'Filled',now())
+                if not record['accepted']:
+                    record['accepted'] = True
+                    if record['close_trade']:
+                        self.close_trade(record)
+                    self.record_fill(record,trade)
+            elif status in DEAD_STATES and not record['filled']:
+                if record['accepted']:
+                    self.reopen_trade(record)
+                if record['trigger_id']:
+                    self.rearm(record)
+        if status == 'Filled' or status in DEAD_STATES:
+            self.orders.pop(trade.order.orderId,None)
+
+    def on_fill(self,trade,fill):
+        record = self.orders.get(trade.order.orderId)
+        if record is None:
+            return
+        record['filled'] = trade.orderStatus.filled
+        log.info("Fill for %s: %s at %s filled %s remaining %s",record['ticker'],fill.execution.shares,fill.execution.price,trade.orderStatus.filled,trade.orderStatus.remaining)
+        if record['kind'] != 'buy':
+            self.record_fill(record,trade)
+
+    def close_trade(self,record):
+        ticker = record['ticker']
+        price = record['price']
+        record['cancelled'] = self.trigger_book.cancel_ticker(ticker,now())
+        # the trade may have been bought moments ago and still be queued
+        self.writer.flush()
+        prev_trade = self.con.execute("select buy_price,amount from trades where status='New' and ticker=:ticker",{'ticker':ticker}).fetchone()
+        log.debug('prev trade: %s',prev_trade)
+        if prev_trade is None:
+            return
+        record['trade_ids'] = [row[0] for row in self.con.execute("select trade_id from trades where status='New' and ticker=:ticker",{'ticker':ticker})]
+        self.writer.execute("update trades set status='Complete',sell_price=:sell_price,pnl=:pnl,close_date=:close_date where ticker=:ticker and status='New'",
+            {
+                'ticker':ticker,
+                'sell_price':price,
+                'close_date':now(),
+                'pnl': float(prev_trade[0])*float(prev_trade[1]) - price*float(prev_trade[1])
+            })
+
+    def reopen_trade(self,record):
+        # the order that closed the trade died with nothing filled, so the
+        # position is still open: undo close_trade
+        log.warning("Order for %s died unfilled, reopening its trade",record['ticker'])
+        self.writer.executemany("update trades set status='New',sell_price=null,pnl=null,close_date=null where trade_id=:trade_id",
+            [{'trade_id':trade_id} for trade_id in record['trade_ids']])
+        for trigger_id in record['cancelled']:
+            self.trigger_book.set_status(trigger_id,'Active',None)
+        record['trade_ids'] = []
+        record['cancelled'] = []
+
+    def rearm(self,record):
+        trigger_id = record['trigger_id']
+        if trigger_id in self.rearmed:
+            log.warning("Order for %s was not accepted again, cancelling trigger %s",record['ticker'],trigger_id)
+            self.trigger_book.set_status(trigger_id,'Cancel',now())
+            return
+        self.rearmed.add(trigger_id)
+        log.warning("Order for %s was not accepted, arming trigger %s again",record['ticker'],trigger_id)
+        self.trigger_book.set_status(trigger_id,'Active',None)
+
+    def record_fill(self,record,trade):
+        # replace the trigger price with what IB actually filled at so far
+        avg_price = trade.orderStatus.avgFillPrice
+        if not record['trade_ids'] or not avg_price:
+            return
+        for trade_id in record['trade_ids']:
+            self.writer.execute("update trades set sell_price=:sell_price,pnl=buy_price*amount-:sell_price*amount where trade_id=:trade_id",
+                {'trade_id':trade_id,'sell_price':avg_price})
+
+def now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -0,0 +1,255 @@
+import os
+import math
+import asyncio
+import sqlite3
+import threading
+import pandas as pd
+import yahooquery as yq
+import ib_insync as ib
+import settings
+from datetime import date, datetime, timezone
+
+# Every market data backend answers the same four calls:
+#   history(tickers,start,end,interval)  -> {ticker: frame indexed by (symbol,date)}
+#   intraday(tickers,start,end,interval) -> the same for intraday bars
+#   quotes(tickers)                      -> {ticker: last price}
+#   summary(tickers)                     -> {ticker: {'volume':...}}
+# Each call site asks provider_for(role) for its backend, so history,
+# intraday, quote and summary can each come from a different source.
+
+ROLES = ('history','intraday','quote','summary')
+COLUMNS = ['open','high','low','close','volume','adjclose']
+
+def split_history(candles):
+    # yahooquery returns one frame indexed by (symbol,date) when every symbol
+    # succeeds, otherwise a dict of frames and error messages keyed by symbol
+    frames = {}
+    if isinstance(candles,dict):
+        for ticker, frame in candles.items():
+            if isinstance(frame,pd.DataFrame) and not frame.empty:
+                if frame.index.nlevels == 1:
+                    frame = pd.concat({ticker:frame},names=['symbol','date'])
+                frames[ticker] = frame
+    elif isinstance(candles,pd.DataFrame) and not candles.empty:
+        for ticker, frame in candles.groupby(level=0,sort=False):
+            frames[ticker] = frame
+    return frames
+
+def candle_key(value,interval):
+    stamp = pd.Timestamp(value)
+    if interval == '1d':
+        return stamp.strftime('%Y-%m-%d')
+    if stamp.tzinfo is not None:
+        stamp = stamp.tz_convert('UTC').tz_localize(None)
+    return stamp.strftime('%Y-%m-%d %H:%M:%S')
+
+def date_key(value,interval):
+    if interval == '1d':
+        return value.strftime('%Y-%m-%d')
+    return value.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+def candle_frame(ticker,rows,interval):
+    # rows of (date,open,high,low,close,volume,adjclose) keyed as in the
+    # candles table, daily bars get dates and intraday bars New York times
+    frame = pd.DataFrame([row[1:] for row in rows],columns=COLUMNS)
+    if interval == '1d':
+        dates = [date.fromisoformat(row[0]) for row in rows]
+    else:
+        dates = pd.to_datetime([row[0] for row in rows]).tz_localize('UTC').tz_convert('America/New_York')
+    frame.index = pd.MultiIndex.from_arrays([[ticker]*len(rows),dates],names=['symbol','date'])
+    return frame
+
+class YahooProvider:
+    def ticker(self,tickers,timeout=None):
+        return yq.Ticker(tickers,asynchronous=True,timeout=timeout)
+
+    def history(self,tickers,start,end,interval='1d',timeout=None):
+        return split_history(self.ticker(tickers,timeout).history(start=start,end=end,interval=interval))
+
+    def intraday(self,tickers,start,end,interval='5m',timeout=None):
+        return self.history(tickers,start,end,interval,timeout)
+
+    def quotes(self,tickers,timeout=None):
+        prices = {}
+        quotes = self.ticker(tickers,timeout).quotes
+        if isinstance(quotes,dict):
+            for ticker in tickers:
+                quote = quotes.get(ticker)
+                if isinstance(quote,dict) and "regularMarketPrice" in quote:
+                    prices[ticker] = quote["regularMarketPrice"]
+        return prices
+
+    def summary(self,tickers,timeout=None):
+        summary = {}
+        details = self.ticker(tickers,timeout).summary_detail
+        if isinstance(details,dict):
+            for ticker in tickers:
+                detail = details.get(ticker)
+                if isinstance(detail,dict):
+                    summary[ticker] = detail
+        return summary
+
+    def modules(self,ticker,modules):
+        # several quoteSummary modules for one ticker in one request
+        found = yq.Ticker(ticker).get_modules(modules)
+        if not isinstance(found.get(ticker),dict):
+            raise ValueError(str(found.get(ticker)))
+        return found[ticker]
+
+class IBProvider:
+    # reqHistoricalData and reqTickers through an IB connection whose event
+    # loop is running, as in the GUI. It has to be built on the thread that
+    # runs that loop: calls from the scan's worker threads are handed to the
+    # loop saved here, calls on the loop's own thread run nested.
+    bar_sizes = {'1m':'1 min','5m':'5 mins','15m':'15 mins','30m':'30 mins','1h':'1 hour','1d':'1 day'}
+
+    def __init__(self,ib_conn,contract_cache=None,timeout=None):
+        self.ib = ib_conn
+        self.contract_cache = contract_cache
+        self.timeout = timeout or getattr(settings,'ib_timeout',60)
+        self.loop = ib.util.getLoop()
+        self.loop_thread = threading.current_thread()
+
+    def contract(self,ticker):
+        if self.contract_cache:
+            return self.contract_cache.stock(ticker)
+        return ib.Stock(ticker,'SMART','USD')
+
+    def run(self,coro,timeout=None):
+        # never waits without a limit, a request IB does not answer raises TimeoutError
+        timeout = timeout or self.timeout
+        if not self.ib.isConnected():
+            coro.close()
+            raise ConnectionError("IB is not connected")
+        if threading.current_thread() is self.loop_thread:
+            return self.ib.run(coro,timeout=timeout)
+        future = asyncio.run_coroutine_threadsafe(coro,self.loop)
+        try:
+            return future.result(timeout)
+        except Exception:
+            future.cancel()
+            raise
+
+    def duration(self,start,end):
+        days = max((end - start).days + 1,1)
+        if days > 365:
+            return str(math.ceil(days/365)) + ' Y'
+        return str(days) + ' D'
+
+    async def fetch_history(self,tickers,start,end,interval):
+        return await asyncio.gather(*[self.ib.reqHistoricalDataAsync(self.contract(ticker),endDateTime=end,durationStr=self.duration(start,end),
+            barSizeSetting=self.bar_sizes[interval],whatToShow='TRADES',useRTH=True,formatDate=2) for ticker in tickers],return_exceptions=True)
+
+    def history(self,tickers,start,end,interval='1d',timeout=None):
+        frames = {}
+        for ticker, bars in zip(tickers,self.run(self.fetch_history(tickers,start,end,interval),timeout)):
+            if isinstance(bars,Exception) or not bars:
+                continue
+            # formatDate=2 gives intraday bars as UTC datetimes, keyed the way the candles table is
+            rows = [(candle_key(bar.date,interval),bar.open,bar.high,bar.low,bar.close,bar.volume,bar.close) for bar in bars]
+            frames[ticker] = candle_frame(ticker,rows,interval)
+        return frames
+
+    def intraday(self,tickers,start,end,interval='5m',timeout=None):
+        return self.history(tickers,start,end,interval,timeout)
+
+    def tickers(self,tickers,timeout=None):
+        return self.run(self.ib.reqTickersAsync(*[self.contract(ticker) for ticker in tickers]),timeout)
+
+    def quotes(self,tickers,timeout=None):
+        prices = {}
+        for ticker in self.tickers(tickers,timeout):
+            price = ticker.marketPrice()
+            if not math.isnan(price):
+                prices[ticker.contract.symbol] = price
+        return prices
+
+    def summary(self,tickers,timeout=None):
+        return {ticker.contract.symbol:{'volume':ticker.volume} for ticker in self.tickers(tickers,timeout)}
+
+class ReplayProvider:
+    # recorded candles served back without touching the network, from a
+    # database with a candles table like qtrader.db or from a directory of
+    # TICKER_INTERVAL.csv files holding the same date,open,...,adjclose
+    # columns. Quotes and summaries come from the latest stored daily bar.
+    def __init__(self,path=None):
+        self.path = path or getattr(settings,'replay_path','qtrader.db')
+        self.local = threading.local()
+
+    def connect(self):
+        con = getattr(self.local,'con',None)
+        if con is None:
+            con = sqlite3.connect(self.path,timeout=30)
+            self.local.con = con
+        return con
+
+    def rows(self,ticker,interval,start=None,end=None):
+        start = date_key(start,interval) if start else ''
+        end = date_key(end,interval) if end else '9999'
+        if os.path.isdir(self.path):
+            filename = os.path.join(self.path,ticker + '_' + interval + '.csv')
+            if not os.path.exists(filename):
+                return []
+            recorded = pd.read_csv(filename,dtype={'date':str})
+            recorded = recorded[(recorded['date']>=start) & (recorded['date']<=end)].sort_values('date')
+            return list(recorded[['date'] + COLUMNS].itertuples(index=False,name=None))
+        return self.connect().execute("select date,open,high,low,close,volume,adjclose from candles where ticker=:ticker and interval=:interval and date>=:start and date<=:end order by date",
+            {'ticker':ticker,'interval':interval,'start':start,'end':end}).fetchall()
+
+    def history(self,tickers,start,end,interval='1d',timeout=None):
+        frames = {}
+        for ticker in tickers:
+            rows = self.rows(ticker,interval,start,end)
+            if rows:
+                frames[ticker] = candle_frame(ticker,rows,interval)
+        return frames
+
+    def intraday(self,tickers,start,end,interval='5m',timeout=None):
+        return self.history(tickers,start,end,interval,timeout)
+
+    def latest(self,ticker):
+        if os.path.isdir(self.path):
+            rows = self.rows(ticker,'1d',end=datetime.now())
+            return rows[-1] if rows else None
+        return self.connect().execute("select date,open,high,low,close,volume,adjclose from candles where ticker=:ticker and interval='1d' and date<=:end order by date desc limit 1",
+            {'ticker':ticker,'end':date_key(datetime.now(),'1d')}).fetchone()
+
+    def quotes(self,tickers,timeout=None):
+        prices = {}
+        for ticker in tickers:
+            bar = self.latest(ticker)
+            if bar:
+                prices[ticker] = bar[4]
+        return prices
+
+    def summary(self,tickers,timeout=None):
+        summary = {}
+        for ticker in tickers:
+            bar = self.latest(ticker)
+            if bar:
+                summary[ticker] = {'volume':bar[5]}
+        return summary
+
+providers = {}
+overrides = {}
+
+def register(name,provider):
+    providers[name] = provider
+
+def get_provider(name):
+    if name not in providers:
+        raise ValueError("No market data provider called " + str(name))
+    return providers[name]
+
+def provider_for(role):
+    # settings.<role>_provider names the backend for a role unless
+    # use_provider has switched it for this process
+    return get_provider(overrides.get(role) or getattr(settings,role + '_provider','yahoo'))
+
+def use_provider(name,roles=ROLES):
+    get_provider(name)
+    for role in roles:
+        overrides[role] = name
+
+register('yahoo',YahooProvider())
+register('replay',ReplayProvider())
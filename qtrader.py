@@ -3,36 +3,38 @@ import sys
 import csv
 import pytz
 import math
-import sqlite3
-import requests
+import atexit
+import logging
 import ib_insync as ib
 from PySide6 import QtCore, QtGui
-from PySide6.QtCore import Slot,QPointF,QDateTime,QUrl
+from PySide6.QtCore import Slot,Qt,QPointF,QDateTime,QUrl
 from PySide6.QtWidgets import *
 from PySide6.QtCharts import *
 from PySide6.QtGui import *
-import yfinance as yf
-import yahooquery as yq
 import pandas as pd
 import numpy as np
 import settings
+from db import con, connect, update_table, writer
+from marketdata import latest_price, quote_cache
+from triggers import TriggerBook
+from orders import OrderManager
+from contracts import ContractCache
+from scanner import buy_levels, run_scan, ScanEngine, export_shortlist, SHORTLIST_QUERY, SHORTLIST_HEADERS, SCORE_HEADERS
+from charts import chart_columns
+from snapshot import snapshot_cache
+from models import QueryModel, ThresholdFilter, TriggerModel, ComboDelegate
+from metrics import metrics, setup_logging
+from providers import IBProvider, register
 from datetime import datetime, timedelta
 
-con = sqlite3.connect("qtrader.db")
+log = logging.getLogger('qtrader')
+
 current_ib = ib.IB()
+trigger_book = TriggerBook(con)
+contract_cache = ContractCache(current_ib,con)
+order_manager = OrderManager(current_ib,con,trigger_book,contract_cache)
 newYorkTz = pytz.timezone("America/New_York")
 
-def latest_price(ticker):
-    tickerQuery = yq.Ticker(ticker, asynchronous=False, Timeout=100)
-    if "regularMarketPrice" in tickerQuery.price[ticker]:
-        try:
-            return tickerQuery.price[ticker]["regularMarketPrice"]
-        except Exception as exp:
-            print("Can't get price for:",tickerQuery.price[ticker])
-            return 0
-    else:
-        return 0
-
 def connect_ib():
     if not current_ib.isConnected():
         print("Currently not connected")
@@ -45,410 +47,290 @@ def connect_ib():
             print("Fail to connect to IB")
             print(e)
 
-def update_table():
-    cursor = con.cursor()
-    cursor.execute("create table if not exists trades(trade_id INTEGER PRIMARY KEY,trade_date,ticker,setup,buy_price,sell_price,amount,stop_loss,r1,r2,total,status,pnl,close_date)")
-    cursor.execute("create table if not exists trigger(trigger_id INTEGER PRIMARY KEY,trade_date,ticker,status,trigger_type,price,pnl,close_date)")
-    cursor.execute("create table if not exists stocks(stocks_id INTEGER PRIMARY KEY,name,ticker,price,bear_score,vol_score,bounce_score,bear_steps,bounce_steps,pullbackswallow,opt_size,volume,tradecount)")
-    con.commit()
-    cursor.close()
-
-def find_levels(candles):
-    levels = []
-    size_mean = np.mean(candles['high']-candles['low'])
-    for i in range(2,len(candles)-2):
-        if is_support(candles,i):
-            val = candles['low'][i]
-            if is_far_from_levels(val,size_mean,levels):
-                levels.append(val)
-        elif is_resistance(candles,i):
-            val = candles['high'][i]
-            if is_far_from_levels(val,size_mean,levels):
-                levels.append(val)
-    return size_mean,levels
-
-def is_support(candles,i):     # i is at lowest low
-    cond1 = candles['low'][i] <= candles['low'][i-1]
-    cond2 = candles['low'][i] <= candles['low'][i+1]
-    cond3 = candles['low'][i+1] < candles['low'][i+2]
-    cond4 = candles['low'][i-1] < candles['low'][i-2]
-    return cond1 and cond2 and cond3 and cond4
-
-def is_resistance(candles,i):  # i is at highest high
-    cond1 = candles['high'][i] >= candles['high'][i-1]
-    cond2 = candles['high'][i] >= candles['high'][i+1]
-    cond3 = candles['high'][i+1] > candles['high'][i+2]
-    cond4 = candles['high'][i-1] > candles['high'][i-2]
-    return cond1 and cond2 and cond3 and cond4
-
-def highest_low(candles,i):  # i is at highest low
-    cond1 = candles['low'][i] >= candles['low'][i-1]
-    cond2 = candles['low'][i] >= candles['low'][i+1]
-    cond3 = candles['low'][i+1] > candles['low'][i+2]
-    cond4 = candles['low'][i-1] > candles['low'][i-2]
-    return cond1 and cond2 and cond3 and cond4
-
-def lowest_high(candles,i):  # i is at lowest high
-    cond1 = candles['high'][i] <= candles['high'][i-1]
-    cond2 = candles['high'][i] <= candles['high'][i+1]
-    cond3 = candles['high'][i+1] < candles['high'][i+2]
-    cond4 = candles['high'][i-1] < candles['high'][i-2]
-    return cond1 and cond2 and cond3 and cond4
-
-def is_far_from_levels(val,size_mean,levels):
-    return np.sum([abs(val-x) < size_mean for x in levels]) == 0
-
-def candle_size(candle):
-    return candle['high'] - candle['low']
-
-def red_candle(candle):
-    if candle['open'] > candle['close']:
-        return True
-    elif candle['open'] < candle['close']:
-        return False
-    else:
-        if candle['high'] - candle['close'] > candle['close'] - candle['low']:
-            return True
-        else:
-            return False
-
-def green_candle(candle):
-    return not red_candle(candle)
-
-def clean_bear_movement(first,second):
-    score = 0
-    if second['high']<=first['high']:
-        score += 1
-    if second['low']<=first['low']:
-        score += 1
-    if second['open']<=first['open']:
-        score += 1
-    if second['close']<=first['close']:
-        score += 1
-    return score
-
-def clean_bull_movement(first,second):
-    score = 0
-    if second['high']>=first['high']:
-        score += 1
-    if second['low']>=first['low']:
-        score += 1
-    if second['open']>=first['open']:
-        score += 1
-    if second['close']>=first['close']:
-        score += 1
-    return score
-
-
-class ScanListTable(QTableWidget):
-    headers = ['Ticker','Name','Price','Opt Size','Volume','Bear Steps','Bounce Steps','Swallow','Trade Count']
+class PositionStream:
+    # keeps one IB market data subscription per open position and passes
+    # every new price to on_price(ticker,price)
+    def __init__(self,ib_conn,on_price):
+        self.ib = ib_conn
+        self.on_price = on_price
+        self.tickers = {}
+        self.amounts = {}
+        self.ib.pendingTickersEvent += self.on_pending
+        self.ib.positionEvent += self.on_position
+
+    def sync(self):
+        held = {}
+        for position in self.ib.positions():
+            if position.position:
+                held[position.contract.localSymbol] = position.position
+        self.amounts = held
+        for ticker in list(self.tickers):
+            if ticker not in held:
+                log.info("Dropping market data for %s",ticker)
+                self.ib.cancelMktData(self.tickers.pop(ticker).contract)
+        for ticker in held:
+            if ticker not in self.tickers:
+                log.info("Subscribing market data for %s",ticker)
+                self.tickers[ticker] = self.ib.reqMktData(contract_cache.stock(ticker))
+
+    def has_price(self,ticker):
+        return ticker in self.tickers and not math.isnan(self.tickers[ticker].marketPrice())
+
+    def price(self,ticker):
+        return self.tickers[ticker].marketPrice()
+
+    def on_position(self,position):
+        self.sync()
+
+    def on_pending(self,tickers):
+        for tick in tickers:
+            ticker = tick.contract.symbol
+            price = tick.marketPrice()
+            if ticker in self.tickers and not math.isnan(price):
+                self.on_price(ticker,price)
+
+class ScanListTable(QTableView):
+    headers = SHORTLIST_HEADERS + SCORE_HEADERS
     def __init__(self):
         super().__init__()
-        self.setColumnCount(len(self.headers))
+        self.stocks = QueryModel(con,SHORTLIST_QUERY,self.headers)
+        self.filter = ThresholdFilter()
+        self.filter.setSourceModel(self.stocks)
+        self.setModel(self.filter)
         self.setAlternatingRowColors(True)
-        self.update_list()
+        self.setSelectionBehavior(QAbstractItemView.SelectRows)
         header = self.horizontalHeader()
-        header.setSectionResizeMode(0,QHeaderView.ResizeMode.Stretch)
-        header.setSectionResizeMode(1,QHeaderView.ResizeMode.Stretch)
-        header.setSectionResizeMode(2,QHeaderView.ResizeMode.Stretch)
-        header.setSectionResizeMode(3,QHeaderView.ResizeMode.Stretch)
-        header.setSectionResizeMode(4,QHeaderView.ResizeMode.Stretch)
-        header.setSectionResizeMode(5,QHeaderView.ResizeMode.Stretch)
-        header.setSectionResizeMode(6,QHeaderView.ResizeMode.Stretch)
-        header.setSectionResizeMode(7,QHeaderView.ResizeMode.Stretch)
-        header.setSectionResizeMode(8,QHeaderView.ResizeMode.Stretch)
-        self.setHorizontalHeaderLabels(self.headers)
-
-    def export_csv(self):
-        cursor = con.cursor()
-        stocks = cursor.execute("select ticker,name,price,opt_size,volume,bear_steps,bounce_steps,pullbackswallow,tradecount,bear_score,bounce_score,vol_score from stocks where bear_steps > 0 and bounce_steps > 0 order by tradecount desc, volume desc, opt_size desc, bear_steps desc, bear_score desc, vol_score desc, bounce_steps desc, bounce_score desc")
-        with open('shortlist_' + datetime.now().strftime("%Y_%m_%d_%H_%M_%S") + '.csv','w') as f:
-            writer = csv.writer(f)
-            writer.writerow(self.headers + ['Bear Score','Bounce Score','Volume Score','Latest close','Colour','Gap','Candle Size','Gap Size'])
-            for stock in stocks.fetchall():
-                end_date = datetime.now()
-                days = 5
-                start_date = end_date - timedelta(days=days)
-                try:
-                    ticker = yq.Ticker(stock[0])
-                    candles = ticker.history(start=start_date,end=end_date)
-                    latest = candles.iloc[-1]
-                    secondlatest = candles.iloc[-2]
-                    color = 'Green'
-                    if red_candle(latest):
-                        color = 'Red'
-                    gap = 'Up'
-                    if latest['open']<secondlatest['close']:
-                        gap = 'Down'
-                    gapsize = latest['open'] - secondlatest['close']
-                    writer.writerow(stock + tuple([latest['close'],color,gap,candle_size(latest),gapsize]))
-                except Exception as exp:
-                    print("Processing ",stock[1]," got error:",exp)
-        dlg = QMessageBox(self)
-        dlg.setWindowTitle("Export complete")
-        dlg.setText("Done export")
-        dlg.exec()
-        print("Done export")
-        cursor.close()
+        header.setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+        # keep the order SHORTLIST_QUERY gives until a column header is clicked
+        header.setSortIndicator(-1,Qt.AscendingOrder)
+        self.setSortingEnabled(True)
 
     def update_list(self):
-        cursor = con.cursor()
-        stocks = cursor.execute("select ticker,name,price,opt_size,volume,bear_steps,bounce_steps,pullbackswallow,tradecount,bear_score,bounce_score,vol_score from stocks where bear_steps > 0 and bounce_steps > 0 order by tradecount desc, volume desc, opt_size desc, bear_steps desc, bear_score desc, vol_score desc, bounce_steps desc, bounce_score desc")
-        self.clear()
-        self.setRowCount(0)
-        for stock in stocks:
-            curpos = self.rowCount()
-            self.insertRow(curpos)
-            tickertxt = stock[0]
-            if tickertxt:
-                tickertxt = tickertxt.strip()
-            self.setItem(curpos,0,QTableWidgetItem(tickertxt))
-            self.setItem(curpos,1,QTableWidgetItem(stock[1]))
-            self.setItem(curpos,2,QTableWidgetItem(str(stock[2])))
-            self.setItem(curpos,3,QTableWidgetItem(str(stock[3])))
-            self.setItem(curpos,4,QTableWidgetItem(str(stock[4])))
-            self.setItem(curpos,5,QTableWidgetItem(str(stock[5])))
-            self.setItem(curpos,6,QTableWidgetItem(str(stock[6])))
-            self.setItem(curpos,7,QTableWidgetItem(str(stock[7])))
-            self.setItem(curpos,8,QTableWidgetItem(str(stock[8])))
-        self.setHorizontalHeaderLabels(self.headers)
-        cursor.close()
+        self.stocks.reload()
+
+    def ticker_at(self,index):
+        return self.stocks.key_at(self.filter.mapToSource(index).row()).strip()
+
+    @Slot(object)
+    def append_stock(self,result):
+        if result['bear_steps'] > 0 and result['bounce_steps'] > 0:
+            self.stocks.upsert([result['ticker'],result['name'],result['price'],result['opt_size'],result['volume'],result['bear_steps'],result['bounce_steps'],result['pullbackswallow'],result['tradecount'],result['bear_score'],result['bounce_score'],result['vol_score']])
 
+class ScanThread(QtCore.QThread):
+    progress = QtCore.Signal(int,int,str)
+    found = QtCore.Signal(object)
+
+    def __init__(self,stale_hours=0):
+        super().__init__()
+        self.stale_hours = stale_hours
+        self.engine = ScanEngine()
+
+    def run(self):
+        # reads need a connection of their own, writes go through db.writer
+        scan_con = connect()
+        try:
+            run_scan(scan_con,'zacks_list.csv',days=120,stale_hours=self.stale_hours,engine=self.engine,
+                on_result=self.found.emit,on_progress=self.report_progress)
+        except Exception as exp:
+            print("Scan failed:",exp)
+        finally:
+            scan_con.close()
+
+    def report_progress(self,done,total,eta):
+        self.progress.emit(done,total,str(eta).split('.')[0] if eta is not None else '-')
+
+class ExportThread(QtCore.QThread):
+    progress = QtCore.Signal(int,int)
+    done = QtCore.Signal(str)
+
+    def run(self):
+        export_con = connect()
+        try:
+            self.done.emit(export_shortlist(export_con,on_progress=self.progress.emit))
+        except Exception as exp:
+            print("Export failed:",exp)
+            self.done.emit('')
+        finally:
+            export_con.close()
 
 class ScanWindow(QWidget):
     def __init__(self):
         super().__init__()
         self.list = ScanListTable()
-        self.list.cellDoubleClicked.connect(self.goto_purchase)
+        self.list.doubleClicked.connect(self.goto_purchase)
         layout = QVBoxLayout()
+        filterrow = QHBoxLayout()
+        self.filter_column = QComboBox()
+        self.filter_column.addItems(self.list.headers[2:])
+        self.filter_minimum = QDoubleSpinBox()
+        self.filter_minimum.setRange(-1000000000,1000000000000)
+        self.filter_button = QPushButton("Filter")
+        self.clear_filter_button = QPushButton("Clear Filters")
+        self.filter_label = QLabel("")
+        filterrow.addWidget(QLabel("At least: "))
+        filterrow.addWidget(self.filter_column)
+        filterrow.addWidget(self.filter_minimum)
+        filterrow.addWidget(self.filter_button)
+        filterrow.addWidget(self.clear_filter_button)
+        filterrow.addWidget(self.filter_label)
+        self.filter_button.clicked.connect(self.add_filter)
+        self.clear_filter_button.clicked.connect(self.clear_filters)
+        layout.addLayout(filterrow)
         layout.addWidget(self.list)
         self.update_db_button = QPushButton("Update")
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.setEnabled(False)
         self.export_db_button = QPushButton("Export")
+        self.stale_only = QCheckBox("Only rescan stale tickers")
+        self.progress = QProgressBar()
+        self.progress_label = QLabel("")
+        progressrow = QHBoxLayout()
+        progressrow.addWidget(self.progress)
+        progressrow.addWidget(self.progress_label)
+        progressrow.addWidget(self.cancel_button)
+        layout.addWidget(self.stale_only)
+        layout.addLayout(progressrow)
         layout.addWidget(self.update_db_button)
         layout.addWidget(self.export_db_button)
         self.update_db_button.clicked.connect(self.refresh_db)
+        self.cancel_button.clicked.connect(self.cancel_scan)
         self.export_db_button.clicked.connect(self.export_db)
         self.setLayout(layout)
+        self.scan_thread = None
+        self.export_thread = None
+
+    def closeEvent(self,event):
+        if self.scan_thread and self.scan_thread.isRunning():
+            self.scan_thread.engine.cancel()
+            self.scan_thread.wait()
+        if self.export_thread and self.export_thread.isRunning():
+            self.export_thread.wait()
+        super().closeEvent(event)
 
     @Slot()
-    def goto_purchase(self,row,column):
-        print("Row:",row," Column:",column)
+    def add_filter(self):
+        # columns before Price are text, so the combo starts at column 2
+        self.list.filter.set_threshold(self.filter_column.currentIndex() + 2,self.filter_minimum.value())
+        self.show_filters()
+
+    @Slot()
+    def clear_filters(self):
+        self.list.filter.clear_thresholds()
+        self.show_filters()
+
+    def show_filters(self):
+        thresholds = self.list.filter.thresholds
+        self.filter_label.setText(", ".join(self.list.headers[column] + ">=" + str(minimum) for column, minimum in thresholds.items()))
+
+    @Slot(QtCore.QModelIndex)
+    def goto_purchase(self,index):
+        print("Row:",index.row()," Column:",index.column())
         self.buywindow = BuyWindow()
         self.buywindow.caller = self
         self.buywindow.resize(800,600)
-        self.buywindow.ticker_text.setText(self.list.item(row,0).text().strip())
+        self.buywindow.ticker_text.setText(self.list.ticker_at(index))
         self.buywindow.pressed_update()
         self.buywindow.showMaximized()
         self.buywindow.activateWindow()
 
     @Slot()
     def export_db(self):
-        self.list.export_csv()
+        if self.export_thread and self.export_thread.isRunning():
+            return
+        self.export_thread = ExportThread()
+        self.export_thread.progress.connect(self.export_progress)
+        self.export_thread.done.connect(self.export_finished)
+        self.export_db_button.setEnabled(False)
+        self.progress_label.setText("Exporting")
+        self.export_thread.start()
+
+    @Slot(int,int)
+    def export_progress(self,done,total):
+        self.progress.setMaximum(total)
+        self.progress.setValue(done)
+        self.progress_label.setText("Exported " + str(done) + "/" + str(total))
+
+    @Slot(str)
+    def export_finished(self,filename):
+        self.export_db_button.setEnabled(True)
+        dlg = QMessageBox(self)
+        dlg.setWindowTitle("Export complete")
+        if filename:
+            dlg.setText("Done export to " + filename)
+        else:
+            dlg.setText("Export failed")
+        dlg.exec()
 
     @Slot()
     def refresh_db(self):
-        cursor = con.cursor()
-        stocks = pd.read_csv('zacks_list.csv',header=0)
-        end_date = datetime.now()
-        days = 120
-        start_date = end_date - timedelta(days=days)
-        con.execute("delete from stocks")
-        con.commit()
-        start_time = datetime.now()
-        for i in range(len(stocks.index)-1):
-            if isinstance(stocks.iloc[i]['Ticker'], str):
-                ticker = stocks.iloc[i]['Ticker'].upper()
-                print("Testing ",ticker)
-                dticker = yq.Ticker(ticker)
-                candles = dticker.history(start=start_date,end=end_date)
-            else:
-                continue
-
-            print("Empty candles:",candles.empty)
-            print("Candles length:",len(candles.index))
-            print("Latest price:",latest_price(ticker))
-            if not candles.empty and len(candles.index)>3 and latest_price(ticker)>0.1:
-                print("Got size sample ",len(candles.index))
-                bear_score = 0
-                vol_score = 0
-                bounce_score = 0
-                bear_steps = 0
-                bounce_steps = 0
-                endpos = -1
-                stages = 0      # 0 - pullback, 1 - bear
-                pullbackhigh = None
-                pullbacklow = None
-                pullbackswallow = None
-                bearhigh = None
-                bearlow = None
-                opt_size = 0
-                while endpos>(len(candles.index)*-1)+2 and stages<2:
-                    if stages == 0:
-                        if clean_bull_movement(candles.iloc[endpos - 1],candles.iloc[endpos])>2 and green_candle(candles.iloc[endpos]):
-                            bounce_steps += 1
-                            if not pullbackhigh:
-                                pullbackhigh = candles.iloc[endpos]['close']
-                        else:
-                            if green_candle(candles.iloc[endpos]) and bounce_steps==0:
-                                bounce_steps += 1
-                                pullbackhigh = candles.iloc[endpos]['close']
-                            stages = 1
-                            if pullbackhigh and not pullbacklow:
-                                pullbacklow = candles.iloc[endpos]['open']
-                    elif stages == 1:
-                        if clean_bear_movement(candles.iloc[endpos -1],candles.iloc[endpos])>2 and red_candle(candles.iloc[endpos]):
-                            bear_steps += 1
-                            if not bearlow:
-                                bearlow = candles.iloc[endpos]['close']
-                        else:
-                            stages = 2
-                            if bearlow and not bearhigh:
-                                bearhigh = candles.iloc[endpos]['open']
-                    if pullbackhigh and pullbackhigh > candles.iloc[endpos]['close']:
-                        if pullbackswallow:
-                            pullbackswallow += 1
-                        else:
-                            pullbackswallow = 1
-                    if bounce_steps>2 and stages<1:     # we don't want any extended bull run
-                        stages = 1
-                    endpos -= 1
-                
-                if bear_steps>0 and bearhigh and bearlow:
-                    bear_score = (bearhigh - bearlow) / bear_steps
-                if bounce_steps>0 and pullbackhigh and pullbacklow:
-                    bounce_score = (pullbackhigh - pullbacklow) / bounce_steps
-                    
-                if bear_steps > 0:
-                    size_mean,levels = find_levels(candles)
-                    levels.sort()
-                    end_vol = candles.iloc[-1:-5:-1]['volume'].mean()
-                    all_vol = candles['volume'].mean()
-                    vol_score = end_vol / all_vol
-                    curprice = latest_price(ticker)
-                    if len(levels)>0 and curprice<levels[-1]:
-                        l = 0
-                        while l<len(levels)-1 and curprice>levels[l]:
-                            l+=1
-                        opt_size = levels[l] - curprice
-                    minute_start_date = end_date - timedelta(days=3)
-                    minute_candles = dticker.history(start=minute_start_date,end=end_date,interval='5m')
-                    print("Minute shape:",minute_candles.shape[0])
-
-                    print("Found bear end for ",ticker," score of ",bear_score," end vol:",end_vol," all vol:",all_vol," vol score:",vol_score)
-                    query = "insert into stocks (name,ticker,price,bear_score,bear_steps,vol_score,bounce_score,bounce_steps,pullbackswallow,opt_size,volume,tradecount) values (:name,:ticker,:price,:bear_score,:bear_steps,:vol_score,:bounce_score,:bounce_steps,:pullbackswallow,:opt_size,:volume,:tradecount)"
-                    try:
-                        candlevolume = dticker.summary_detail[ticker]['volume']
-                    except Exception as exp:
-                        candlevolume = 0
-                        print("Error getting volume:",exp)
-                    print("Cur volume:",candlevolume)
-                    con.execute(query,{
-                        'name':stocks.iloc[i]['Company Name'],
-                        'ticker':ticker,
-                        'price':curprice,
-                        'bear_score':bear_score,
-                        'bear_steps':bear_steps,
-                        'vol_score':vol_score,
-                        'bounce_score':bounce_score,
-                        'bounce_steps':bounce_steps,
-                        'pullbackswallow':pullbackswallow,
-                        'opt_size':opt_size,
-                        'volume':candlevolume,
-                        'tradecount':minute_candles.shape[0]
-                        })
-                    con.commit()
-        print("Done scanning")
-        cursor.close()
-        end_time = datetime.now()
-        diff_time = end_time - start_time
-        print("Took ", diff_time)
+        if self.scan_thread and self.scan_thread.isRunning():
+            return
+        stale_hours = 0
+        if self.stale_only.isChecked():
+            stale_hours = getattr(settings,'scan_stale_hours',12)
+        self.scan_thread = ScanThread(stale_hours)
+        self.scan_thread.progress.connect(self.scan_progress)
+        self.scan_thread.found.connect(self.list.append_stock)
+        self.scan_thread.finished.connect(self.scan_finished)
+        self.update_db_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self.progress_label.setText("Starting scan")
+        self.scan_thread.start()
+
+    @Slot()
+    def cancel_scan(self):
+        if self.scan_thread:
+            self.progress_label.setText("Cancelling")
+            self.scan_thread.engine.cancel()
+
+    @Slot(int,int,str)
+    def scan_progress(self,done,total,eta):
+        self.progress.setMaximum(total)
+        self.progress.setValue(done)
+        self.progress_label.setText(str(done) + "/" + str(total) + " ETA " + eta)
+
+    @Slot()
+    def scan_finished(self):
+        self.update_db_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+        engine = self.scan_thread.engine
+        self.progress_label.setText("Took " + str(engine.took).split('.')[0])
+        metrics.export()
         self.list.update_list()
+        if current_ib.isConnected():
+            contract_cache.prefetch([stock[0] for stock in con.execute(SHORTLIST_QUERY)])
         dlg = QMessageBox(self)
         dlg.setWindowTitle("Scan complete")
-        dlg.setText("Scan complete in " + str(diff_time) + " time")
+        dlg.setText("Scan complete in " + str(engine.took) + " time\n" + engine.report())
         dlg.exec()
 
-class TriggerListTable(QTableWidget):
-    headers = ['Date','Ticker','Status','Type','Price','P&L','close Date','Action']
+class TriggerListTable(QTableView):
     combo_selection = ['Active','Filled','Cancel','Submitted']
     type_selection = ['Above','Below']
-    ticker = None
 
     def __init__(self):
         super().__init__()
-        self.setColumnCount(len(self.headers))
+        self.triggers = TriggerModel(con,trigger_book)
+        self.setModel(self.triggers)
         self.setAlternatingRowColors(True)
-        self.update_list()
-        header = self.horizontalHeader()
-        header.setSectionResizeMode(0,QHeaderView.ResizeMode.Stretch)
-        header.setSectionResizeMode(1,QHeaderView.ResizeMode.Stretch)
-        header.setSectionResizeMode(2,QHeaderView.ResizeMode.Stretch)
-        header.setSectionResizeMode(3,QHeaderView.ResizeMode.Stretch)
-        header.setSectionResizeMode(4,QHeaderView.ResizeMode.Stretch)
-        header.setSectionResizeMode(5,QHeaderView.ResizeMode.Stretch)
-        header.setSectionResizeMode(6,QHeaderView.ResizeMode.Stretch)
-        header.setSectionResizeMode(7,QHeaderView.ResizeMode.Stretch)
-        self.setHorizontalHeaderLabels(self.headers)
-    
-    def update_list(self):
-        cursor = con.cursor()
-        if self.ticker:
-            print("Filter by:",self.ticker)
-            trades = cursor.execute("select * from trigger where ticker=:ticker order by trade_date desc",{'ticker':self.ticker})
-        else:
-            trades = cursor.execute("select * from trigger order by trade_date desc")
-        self.clear()
-        self.setRowCount(0)
-        i = 0
-        self.row_id = []
-        self.type_combo = []
-        self.status_combo = []
-        self.price_widget = []
-        self.update_trigger_button = []
-        for trade in trades:
-            curpos = self.rowCount()
-            self.row_id.append(trade[0])
-            self.insertRow(curpos)
-            self.setItem(curpos,0,QTableWidgetItem(trade[1]))
-            self.setItem(curpos,1,QTableWidgetItem(trade[2]))
-            cur_status_combo = QComboBox()
-            cur_status_combo.addItems(self.combo_selection)
-            cur_status_combo.setCurrentText(trade[3])
-            self.status_combo.append(cur_status_combo)
-            self.setCellWidget(curpos,2,self.status_combo[i])
-            cur_type_combo = QComboBox()
-            cur_type_combo.addItems(self.type_selection)
-            cur_type_combo.setCurrentText(trade[4])
-            self.type_combo.append(cur_type_combo)
-            self.setCellWidget(curpos,3,self.type_combo[i])
-            self.price_widget.append(QTableWidgetItem(str(trade[5])))
-            self.setItem(curpos,4,self.price_widget[i])
-            self.setItem(curpos,5,QTableWidgetItem(str(trade[6])))
-            self.setItem(curpos,6,QTableWidgetItem(trade[7]))
-
-            trigger_button = QPushButton("Update")
-            trigger_button.clicked.connect(self.update_row)
-            self.update_trigger_button.append(trigger_button)
-
-            self.setCellWidget(curpos,7,self.update_trigger_button[i])
-            i += 1
-        self.setHorizontalHeaderLabels(self.headers)
-        cursor.close()
+        self.setColumnHidden(0,True)
+        self.status_delegate = ComboDelegate(self.combo_selection,self)
+        self.type_delegate = ComboDelegate(self.type_selection,self)
+        self.setItemDelegateForColumn(3,self.status_delegate)
+        self.setItemDelegateForColumn(4,self.type_delegate)
+        self.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+
+    @property
+    def ticker(self):
+        return self.triggers.ticker
+
+    @ticker.setter
+    def ticker(self,ticker):
+        print("Filter by:",ticker)
+        self.triggers.set_ticker(ticker)
 
-    @Slot(int)
-    def update_row(self):
-        print("Will update row",self.row_id[self.currentRow()])
-        cursor = con.cursor()
-        data = {
-            'price':float(self.price_widget[self.currentRow()].text()),
-            'status':str(self.status_combo[self.currentRow()].currentText()),
-            'type':str(self.type_combo[self.currentRow()].currentText()),
-            'id':self.row_id[self.currentRow()]
-        }
-        print("Data to update:",data)
-        cursor.execute("update trigger set price=:price,status=:status,trigger_type=:type where trigger_id=:id",data)
-        con.commit()
-        cursor.close()
+    def update_list(self):
+        self.triggers.reload()
 
 class TriggerListWindow(QWidget):
     def __init__(self):
@@ -474,7 +356,8 @@ class TriggerListWindow(QWidget):
     def update_list(self,ticker=None):
         if ticker:
             self.list.ticker = ticker
-        self.list.update_list()
+        else:
+            self.list.update_list()
 
 class TradeListTable(QTableWidget):
     headers = ['Date','Ticker','Setup','Price','Units','Loss Limit','R1','R2','P&L']
@@ -507,12 +390,12 @@ class TradeListTable(QTableWidget):
             self.setItem(curpos,0,QTableWidgetItem(trade[1]))
             self.setItem(curpos,1,QTableWidgetItem(trade[2]))
             self.setItem(curpos,2,QTableWidgetItem(trade[3]))
-            self.setItem(curpos,3,QTableWidgetItem(trade[4]))
-            self.setItem(curpos,4,QTableWidgetItem(trade[6]))
-            self.setItem(curpos,5,QTableWidgetItem(trade[7]))
-            self.setItem(curpos,6,QTableWidgetItem(trade[8]))
-            self.setItem(curpos,7,QTableWidgetItem(trade[9]))
-            self.setItem(curpos,8,QTableWidgetItem(trade[12]))
+            self.setItem(curpos,3,QTableWidgetItem(str(trade[4])))
+            self.setItem(curpos,4,QTableWidgetItem(str(trade[6])))
+            self.setItem(curpos,5,QTableWidgetItem(str(trade[7])))
+            self.setItem(curpos,6,QTableWidgetItem(str(trade[8])))
+            self.setItem(curpos,7,QTableWidgetItem(str(trade[9])))
+            self.setItem(curpos,8,QTableWidgetItem(str(trade[12])))
         self.setHorizontalHeaderLabels(self.headers)
         cursor.close()
 
@@ -535,10 +418,25 @@ class TradeListWindow(QWidget):
         layout = QVBoxLayout(self)
         layout.addWidget(self.list)
 
+        self.stream = None
+        if getattr(settings,'price_source','yahoo') == 'ib' and current_ib.isConnected():
+            self.stream = PositionStream(current_ib,self.check_tick)
+            self.stream.sync()
+
         self.timer = QtCore.QTimer()
         self.timer.timeout.connect(self.checkprice)
         self.timer.start(60000)
 
+        self.prefetch_contracts()
+        self.contract_timer = QtCore.QTimer()
+        self.contract_timer.timeout.connect(self.prefetch_contracts)
+        self.contract_timer.start(3600000)
+
+        # checkprice only counts in memory, the file is written this often
+        self.metrics_timer = QtCore.QTimer()
+        self.metrics_timer.timeout.connect(metrics.export)
+        self.metrics_timer.start(getattr(settings,'metrics_interval',600)*1000)
+
         actionrow = QHBoxLayout(self)
         self.ticker_text = QTextEdit("BBBY")
         self.ticker_text.setMaximumHeight(30)
@@ -579,175 +477,55 @@ class TradeListWindow(QWidget):
         print("Done export")
         cursor.close()
 
+    @Slot()
+    def prefetch_contracts(self):
+        # contract details for everything we may place an order on, refreshed
+        # once they are older than settings.contract_refresh
+        if current_ib.isConnected():
+            tickers = [cps[1].localSymbol for cps in current_ib.positions()]
+            tickers += [stock[0] for stock in con.execute(SHORTLIST_QUERY)]
+            contract_cache.prefetch(tickers)
+
+    def check_tick(self,ticker,price):
+        order_manager.check_triggers(ticker,self.stream.amounts.get(ticker,0),price)
+
     @Slot()
     def checkprice(self):
         if current_ib.isConnected():
-            curtime = datetime.now(newYorkTz)
-            print("At New York:",curtime)
-            print("At New York Hour:",curtime.hour)
-            print("At New York Minute:",curtime.minute)
-            print("Minute test:",(curtime.hour==9 and curtime.minute>45)," Hour test:",curtime.hour>9)
-            open_counter = (curtime.hour>9 or (curtime.hour==9 and curtime.minute>45)) and curtime.hour<16
-            selloff_time = curtime.hour>=15 and curtime.minute>=40
-            print("open counter:",open_counter," Sell off time:",selloff_time)
-            print("Checking prices")
-            cursor = con.cursor()
-            cur_pos = current_ib.positions()
-            for cps in cur_pos:  # Loop over stock we own according to ib
-                ticker = cps[1].localSymbol
-                amount = cps[2]
-                print("Checking price for ",ticker)
+            with metrics.timer('checkprice'):
+                self.check_positions()
+
+    def check_positions(self):
+        curtime = datetime.now(newYorkTz)
+        open_counter = (curtime.hour>9 or (curtime.hour==9 and curtime.minute>45)) and curtime.hour<16
+        selloff_time = curtime.hour>=15 and curtime.minute>=40
+        log.debug("At New York: %s open counter: %s Sell off time: %s",curtime,open_counter,selloff_time)
+        if self.stream:
+            self.stream.sync()
+        cur_pos = current_ib.positions()
+        quote_cache.get_many([cps[1].localSymbol for cps in cur_pos if not (self.stream and self.stream.has_price(cps[1].localSymbol))])
+        for cps in cur_pos:  # Loop over stock we own according to ib
+            ticker = cps[1].localSymbol
+            amount = cps[2]
+            log.debug("Checking price for %s",ticker)
+            if self.stream and self.stream.has_price(ticker):
+                # triggers for streamed tickers are checked on every tick in check_tick
+                price = self.stream.price(ticker)
+            else:
                 price = latest_price(ticker)
-                triggers = cursor.execute("select * from trigger where status='Active' and ticker=:ticker and trigger_type=:trigger_type order by price",
-                {'ticker':ticker,'trigger_type':'Above'})
-                trigger = triggers.fetchone()
-                if trigger:
-                    print("Comparing above price ",price," to trigger ",trigger[5])
-                    trigger_price = float(trigger[5])
-                    if price>trigger_price:
-                        print("Price ",price," is higher than trigger ",trigger_price)
-                        divide = len(triggers.fetchall())
-                        if divide==0:
-                            divide = 1
-                        to_sell = math.floor(amount/divide)
-                        stock = ib.Stock(ticker,'SMART','USD')
-                        order = ib.Order()
-                        order.action = 'SELL'
-                        order.orderType = 'TRAIL'
-                        order.totalQuantity = float(to_sell)
-                        order.trailingPercent = 0.1
-                        order.transmit = True
-                        sell = current_ib.placeOrder(stock,order)
-                        current_ib.sleep(5)
-                        print("Trail status:",sell.orderStatus.status)
-                        if sell.orderStatus.status=='Filled' or sell.orderStatus.status=='Submitted':
-                            cursor.execute("update trigger set status='Filled',close_date=:close_date where trigger_id=:id",
-                                {
-                                    'id':trigger[0],
-                                    'close_date':datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                })
-                            if divide==1:
-                                cursor.execute("update trigger set status='Cancel',close_date=:close_date where ticker=:ticker and status='Active'",
-                                    {
-                                        'ticker':ticker,
-                                        'close_date':datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                    })
-                                prev_trade = cursor.execute("select buy_price,amount from trades where status='New' and ticker=:ticker",{'ticker':ticker}).fetchone()
-                                print('prev trade:',prev_trade)
-                                cursor.execute("update trades set status='Complete',sell_price=:sell_price,pnl=:pnl,close_date=:close_date where ticker=:ticker and status='New'",
-                                    {
-                                        'ticker':ticker,
-                                        'sell_price':price,
-                                        'close_date':datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                        'pnl': float(prev_trade[0])*float(prev_trade[1]) - price*float(prev_trade[1])
-                                    })
-                            status = True
-                        elif sell.orderStatus.status=='PreSubmitted':
-                            cursor.execute("update trigger set status='Submitted',close_date=:close_date where trigger_id=:id",
-                                {
-                                    'id':trigger[0],
-                                    'close_date':datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                })
-                            if divide==1:
-                                cursor.execute("update trigger set status='Cancel',close_date=:close_date where ticker=:ticker and status='Active'",
-                                    {
-                                        'ticker':ticker,
-                                        'close_date':datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                    })
-                                prev_trade = cursor.execute("select buy_price,amount from trades where status='New' and ticker=:ticker",{'ticker':ticker}).fetchone()
-                                print('prev trade:',prev_trade)
-                                cursor.execute("update trades set status='Complete',sell_price=:sell_price,pnl=:pnl,close_date=:close_date where ticker=:ticker and status='New'",
-                                    {
-                                        'ticker':ticker,
-                                        'sell_price':price,
-                                        'close_date':datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                        'pnl': float(prev_trade[0])*float(prev_trade[1]) - price*float(prev_trade[1])
-                                    })
-                            status = True
-                        else:
-                            status = False
-                triggers = cursor.execute("select * from trigger where status='Active' and ticker=:ticker and trigger_type=:trigger_type order by price desc",
-                {'ticker':ticker,'trigger_type':'Below'})
-                trigger = triggers.fetchone()
-                if trigger:
-                    print("Comparing below price ",price," to trigger ",trigger[5])
-                    trigger_price = float(trigger[5])
-                    if price<trigger_price:
-                        print("Price ",price," is lower than trigger ",trigger_price)
-                        divide = len(triggers.fetchall())
-                        if divide==0:
-                            divide = 1
-                        to_sell = math.floor(amount/divide)
-                        stock = ib.Stock(ticker,'SMART','USD')
-                        order = ib.Order()
-                        order.lmtPrice = price
-                        order.orderType = 'MKT'
-                        order.transmit = True
-                        order.totalQuantity = float(to_sell)
-                        order.action = 'SELL'
-                        dps = str(current_ib.reqContractDetails(stock)[0].minTick + 1)[::-1].find('.') - 1
-                        order.lmtPrice = round(order.lmtPrice + current_ib.reqContractDetails(stock)[0].minTick * 2,dps)
-                        sell = current_ib.placeOrder(stock,order)
-                        current_ib.sleep(5)
-                        if sell.orderStatus.status=='Filled' or sell.orderStatus.status=='Submitted':
-                            cursor.execute("update trigger set status='Filled',close_date=:close_date where trigger_id=:id",
-                                {
-                                    'id':trigger[0],
-                                    'close_date':datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                })
-                            if divide==1:
-                                cursor.execute("update trigger set status='Cancel',close_date=:close_date where ticker=:ticker and status='Active'",
-                                    {
-                                        'ticker':ticker,
-                                        'close_date':datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                    })
-                                prev_trade = cursor.execute("select buy_price,amount from trades where status='New' and ticker=:ticker",{'ticker':ticker}).fetchone()
-                                cursor.execute("update trades set status='Complete',sell_price=:sell_price,pnl=:pnl,close_date=:close_date where ticker=:ticker and status='New'",
-                                    {
-                                        'ticker':ticker,
-                                        'sell_price':price,
-                                        'close_date':datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                        'pnl': float(prev_trade[0])*float(prev_trade[1]) - price*float(prev_trade[1])
-                                    })
-                            status = True
-                        else:
-                            status = False
-                if selloff_time:
-                    if amount>0:
-                        to_sell = amount
-                        stock = ib.Stock(ticker,'SMART','USD')
-                        order = ib.Order()
-                        order.lmtPrice = price
-                        order.orderType = 'MKT'
-                        order.transmit = True
-                        order.totalQuantity = float(to_sell)
-                        order.action = 'SELL'
-                        dps = str(current_ib.reqContractDetails(stock)[0].minTick + 1)[::-1].find('.') - 1
-                        order.lmtPrice = round(order.lmtPrice + current_ib.reqContractDetails(stock)[0].minTick * 2,dps)
-                        sell = current_ib.placeOrder(stock,order)
-                        current_ib.sleep(5)
-                        if sell.orderStatus.status=='Filled' or sell.orderStatus.status=='Submitted':
-                            cursor.execute("update trigger set status='Cancel',close_date=:close_date where ticker=:ticker and status='Active'",
-                                {
-                                    'ticker':ticker,
-                                    'close_date':datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                })
-                            prev_trade = cursor.execute("select buy_price,amount from trades where status='New' and ticker=:ticker",
-                                {
-                                    'ticker':ticker
-                                }).fetchone()
-                            cursor.execute("update trades set status='Complete',sell_price=:sell_price,pnl=:pnl,close_date=:close_date where ticker=:ticker and status='New'",
-                                {
-                                    'ticker':ticker,
-                                    'sell_price':price,
-                                    'close_date':datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                    'pnl': float(prev_trade[0])*float(prev_trade[1]) - price*float(prev_trade[1])
-                                })
-                            status = True
-                        else:
-                            status = False
-                con.commit()
-            cursor.close()
+                order_manager.check_triggers(ticker,amount,price)
+            if selloff_time and price is not None and price > 0:
+                if amount>0 and not order_manager.working(ticker,'selloff'):
+                    to_sell = amount
+                    stock = contract_cache.stock(ticker)
+                    order = ib.Order()
+                    order.lmtPrice = price
+                    order.orderType = 'MKT'
+                    order.transmit = True
+                    order.totalQuantity = float(to_sell)
+                    order.action = 'SELL'
+                    order.lmtPrice = contract_cache.offset_price(ticker,order.lmtPrice)
+                    order_manager.place(stock,order,'selloff',ticker,price=price,close_trade=True)
 
     @Slot()
     def refresh_list(self):
@@ -792,20 +570,17 @@ class NewsListTable(QTableWidget):
         header.setSectionResizeMode(0,QHeaderView.ResizeMode.Stretch)
         header.setSectionResizeMode(1,QHeaderView.ResizeMode.ResizeToContents)
         self.setHorizontalHeaderLabels(self.headers)
-        self.update_list()
 
-    def update_list(self):
-        if self.tickertxt:
-            url = 'https://www.alphavantage.co/query?function=NEWS_SENTIMENT&tickers=' + self.tickertxt + '&apikey=' + settings.alphavantage_key + '&limit=5'
-            r = requests.get(url)
-            self.news_data = r.json()
-            print("News: ",self.news_data)
-            print("News url: ",url)
-            for feed in self.news_data['feed']:
-                curpos = self.rowCount()
-                self.insertRow(curpos)
-                self.setItem(curpos,0,QTableWidgetItem(str(datetime.strptime(feed['time_published'],'%Y%m%dT%H%M%S').date())))
-                self.setItem(curpos,1,QTableWidgetItem(feed['title']))
+    def show_news(self,tickertxt,news_data):
+        self.tickertxt = tickertxt
+        self.news_data = news_data
+        print("News: ",self.news_data)
+        self.setRowCount(0)
+        for feed in self.news_data['feed']:
+            curpos = self.rowCount()
+            self.insertRow(curpos)
+            self.setItem(curpos,0,QTableWidgetItem(str(datetime.strptime(feed['time_published'],'%Y%m%dT%H%M%S').date())))
+            self.setItem(curpos,1,QTableWidgetItem(feed['title']))
 
     @Slot()
     def open_link(self,item):
@@ -815,6 +590,20 @@ class NewsListTable(QTableWidget):
         print('url:',targeturl)
         QDesktopServices.openUrl(QUrl(targeturl))
 
+class SnapshotThread(QtCore.QThread):
+    part = QtCore.Signal(str,str,object)
+
+    def __init__(self,ticker):
+        super().__init__()
+        self.ticker = ticker
+
+    def run(self):
+        snapshot_cache.load(self.ticker,lambda part,value: self.part.emit(self.ticker,part,value))
+
+# running snapshot threads, kept here so closing a BuyWindow does not
+# destroy a thread that is still fetching
+snapshot_threads = set()
+
 class BuyWindow(QWidget):
     def __init__(self):
         super().__init__()
@@ -874,7 +663,7 @@ class BuyWindow(QWidget):
             print("Connected to IB")
             nextId = current_ib.client.getReqId()
             print("Next ID:",nextId)
-            stock = ib.Stock(self.ticker_text.text(),'SMART','USD')
+            stock = contract_cache.stock(self.ticker_text.text())
             order = ib.Order()
             order.orderId = nextId
             order.action = 'BUY'
@@ -886,9 +675,8 @@ class BuyWindow(QWidget):
             else:
                 order.transmit = True
 
-            dps = str(current_ib.reqContractDetails(stock)[0].minTick + 1)[::-1].find('.') - 1
-            order.lmtPrice = round(order.lmtPrice + current_ib.reqContractDetails(stock)[0].minTick * 2,dps)
-            bought = current_ib.placeOrder(stock,order)
+            order.lmtPrice = contract_cache.offset_price(stock.symbol,order.lmtPrice)
+            order_manager.place(stock,order,'buy',stock.symbol)
 
             if self.place_order.isChecked():
                 takeProfit = ib.Order()
@@ -900,7 +688,7 @@ class BuyWindow(QWidget):
                 takeProfit.parentId = nextId
                 takeProfit.transmit = False
                 takeProfit.tif = 'GTC'
-                bought2 = current_ib.placeOrder(stock,takeProfit)
+                order_manager.place(stock,takeProfit,'buy',stock.symbol)
 
                 stopLoss = ib.Order()
                 stopLoss.orderId = order.orderId + 2
@@ -914,18 +702,10 @@ class BuyWindow(QWidget):
                 #to activate all its predecessors
                 stopLoss.transmit = True
                 stopLoss.tif = 'GTC'
-                bought3 = current_ib.placeOrder(stock,stopLoss)
+                order_manager.place(stock,stopLoss,'buy',stock.symbol)
 
-            current_ib.sleep(5)
-            if bought.orderStatus.status=='Filled' or bought.orderStatus.status=='Submitted':
-                print("Placed order for",self.ticker_text.text())
-                status = True
-            else:
-                print("Not able to place order")
-                status = False
         else:
             print("Not connected to IB")
-        cursor = con.cursor()
         query = "insert into trades(trade_date,ticker,setup,buy_price,sell_price,amount,stop_loss,r1,r2,total,status,pnl) values (:trade_date,:ticker,:setup,:buy_price,:sell_price,:amount,:stop_loss,:r1,:r2,:total,:status,:pnl)"
         data = {
             "trade_date":datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
@@ -943,13 +723,11 @@ class BuyWindow(QWidget):
         }
         print("Query:",query)
         print("Data:",data)
-        cursor.execute(query,data)
-        con.commit()
+        writer.execute(query,data)
         savestatus = 'Active'
         if self.place_order.isChecked():
             savestatus = 'Submitted'
 
-        query = "insert into trigger(trade_date,ticker,status,trigger_type,price) values (:trade_date,:ticker,:status,:trigger_type,:price)"
         data = [
             {
                 "trade_date":datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
@@ -974,11 +752,10 @@ class BuyWindow(QWidget):
                 "trigger_type":"Above",
                 "price":float(self.r2_text.text())
             })
-        print("Query:",query)
-        print("Data:",data)
-        cursor.executemany(query,data)
-        con.commit()
-        cursor.close()
+        print("Triggers:",data)
+        for trigger in data:
+            trigger_book.add(trigger['trade_date'],trigger['ticker'],trigger['status'],trigger['trigger_type'],trigger['price'])
+        writer.flush()
         print("Buy ticker ",self.ticker_text.text())
         self.caller.list.update_list()
         self.caller.activateWindow()
@@ -1082,102 +859,98 @@ class BuyWindow(QWidget):
         self.update_chart()
 
     def update_chart(self):
-        end_date = datetime.now()
-        days = 120
-        start_date = end_date - timedelta(days=days)
-        candles = pd.DataFrame()
-        levels = []
         tickertxt = self.ticker_text.text().strip().upper()
         print("Tickertxt:",tickertxt)
+        self.snapshot_ticker = tickertxt
+        self.snapshot = {}
+        thread = SnapshotThread(tickertxt)
+        thread.part.connect(self.snapshot_part)
+        thread.finished.connect(lambda: snapshot_threads.discard(thread))
+        snapshot_threads.add(thread)
+        thread.start()
+
+    @Slot(str,str,object)
+    def snapshot_part(self,ticker,part,value):
+        # parts of an earlier ticker still arriving after Update was pressed again
+        if ticker != self.snapshot_ticker:
+            return
+        self.snapshot[part] = value
         try:
-            ticker = yq.Ticker(tickertxt)
-            print("Ticker:",ticker.summary_detail)
-            print("Ticker price:",ticker.price)
-            print("Ticker events:",ticker.calendar_events)
-            self.news_tab.tickertxt = tickertxt
-            self.news_tab.update_list()
-            self.marketcap_label.setText(str(ticker.summary_detail[tickertxt]['marketCap']))
-            self.volume24h_label.setText(str(ticker.summary_detail[tickertxt]['volume']))
-            self.yearhigh_label.setText(str(ticker.summary_detail[tickertxt]['fiftyTwoWeekHigh']))
-            self.yearlow_label.setText(str(ticker.summary_detail[tickertxt]['fiftyTwoWeekLow']))
-            candles = ticker.history(start=start_date,end=end_date)
-            candles['timestamp'] = [ pd.Timestamp(dt[1]) for dt in candles.index.values ]
-            ymin = candles['low'].min()
-            ymax = candles['high'].max()
-            size_mean,levels = find_levels(candles)
-            levels.sort()
-            self.levels_label.setText(','.join([ str(x) for x in levels]))
-            lastcandle = candles.iloc[-1]
-            self.price = latest_price(self.ticker_text.text().upper())
-            self.size_mean_label.setText(str(size_mean) + " ----- " + str(size_mean+self.price))
-            curend = -2
-            endloop = len(candles) * -1
-            while curend>endloop and candles.iloc[curend]['low']>self.price:
-                curend -= 1
-            if curend>endloop:
-                self.stop_text.setText(str(round(candles.iloc[curend]['low'],4)))
-            else:
-                self.stop_text.setText(str(round(lastcandle['low'],4)))
-            self.price_text.setText(str(round(self.price,4)))
-            self.update_price()
-            self.r2_text.setText("")
-            if len(levels)>0 and self.price<levels[-1]:
-                i = 0
-                while i<len(levels)-1 and self.price>levels[i]:
-                    i+=1
-                self.r1_text.setText(str(round(levels[i],4)))
-                j = i + 1
-                if j<len(levels):
-                    while self.price>levels[j] and j<len(levels):
-                        j+=1
-                    if j>i:
-                        self.r2_text.setText(str(round(levels[j],4)))
-            else:
-                self.r1_text.setText(str(math.ceil(self.price)))
-            acmeSeries = QCandlestickSeries()
-            acmeSeries.setName(self.ticker_text.text())
-            acmeSeries.setIncreasingColor(QColor(Qt.green))
-            acmeSeries.setDecreasingColor(QColor(Qt.red))
-
-            volumeSeries = QBarSeries()
-            vset = QBarSet('volume')
-
-            categories = []
-            for idx in range(len(candles)):
-                candle = candles.iloc[idx]
-                candlestickSet = QCandlestickSet(candle['open'],candle['high'],candle['low'],candle['close'],QDateTime(candle['timestamp']).toMSecsSinceEpoch())
-                acmeSeries.append(candlestickSet)
-                categories.append(QDateTime(candle['timestamp']).toMSecsSinceEpoch())
-                vset.append(candle['volume'])
-
-            volumeSeries.append(vset)
-
-            self.chart.removeAllSeries()
-            self.chart.addSeries(acmeSeries)
-            self.chart.createDefaultAxes()
-            self.chart.axisX().setLabelsAngle(-90)
-            self.chart.axisY().setMax(ymax * 1.1)
-            self.chart.axisY().setMin(ymin * 0.9)
-
-            self.volchart.removeAllSeries()
-            self.volchart.addSeries(volumeSeries)
-            self.volchart.createDefaultAxes()
+            if part == 'modules':
+                self.show_summary(value)
+            elif part == 'news_update' or (part == 'news' and 'news_update' not in self.snapshot):
+                self.news_tab.show_news(ticker,value)
+            elif part == 'candles':
+                self.show_candles(ticker,value)
+            if part in ('candles','price') and 'candles' in self.snapshot and 'price' in self.snapshot:
+                self.show_levels(self.snapshot['candles'],self.snapshot['price'])
         except Exception as exp:
-            print("Exception for |","|","| (",tickertxt,") : ",exp)
-            candles = pd.DataFrame()
+            print("Exception for |","|","| (",ticker,") : ",exp)
+
+    def show_summary(self,modules):
+        detail = modules.get('summaryDetail',{})
+        print("Ticker:",detail)
+        print("Ticker price:",modules.get('price'))
+        print("Ticker events:",modules.get('calendarEvents'))
+        self.marketcap_label.setText(str(detail.get('marketCap')))
+        self.volume24h_label.setText(str(detail.get('volume')))
+        self.yearhigh_label.setText(str(detail.get('fiftyTwoWeekHigh')))
+        self.yearlow_label.setText(str(detail.get('fiftyTwoWeekLow')))
+
+    def show_levels(self,candles,price):
+        found = buy_levels(candles,price)
+        self.levels_label.setText(','.join([ str(x) for x in found['levels']]))
+        self.price = price
+        self.size_mean_label.setText(str(found['size_mean']) + " ----- " + str(found['size_mean']+self.price))
+        self.stop_text.setText(str(round(found['stop'],4)))
+        self.price_text.setText(str(round(self.price,4)))
+        self.update_price()
+        self.r1_text.setText(str(round(found['r1'],4)))
+        self.r2_text.setText("" if found['r2'] is None else str(round(found['r2'],4)))
+
+    def show_candles(self,ticker,candles):
+        columns = chart_columns(candles)
+        ymin = min(columns['low'])
+        ymax = max(columns['high'])
+        acmeSeries = QCandlestickSeries()
+        acmeSeries.setName(ticker)
+        acmeSeries.setIncreasingColor(QColor(Qt.green))
+        acmeSeries.setDecreasingColor(QColor(Qt.red))
+
+        volumeSeries = QBarSeries()
+        vset = QBarSet('volume')
+
+        acmeSeries.append([QCandlestickSet(*bar) for bar in zip(columns['open'],columns['high'],columns['low'],columns['close'],columns['time'])])
+        vset.append(columns['volume'])
+        volumeSeries.append(vset)
+
+        # animating hundreds of bars makes the window feel slow to open
+        animation = QChart.SeriesAnimations
+        if len(columns['time']) > getattr(settings,'chart_animation_bars',150):
+            animation = QChart.NoAnimation
+        self.chart.setAnimationOptions(animation)
+        self.volchart.setAnimationOptions(animation)
+
+        self.chart.removeAllSeries()
+        self.chart.addSeries(acmeSeries)
+        self.chart.createDefaultAxes()
+        self.chart.axisX().setLabelsAngle(-90)
+        self.chart.axisY().setMax(ymax * 1.1)
+        self.chart.axisY().setMin(ymin * 0.9)
+
+        self.volchart.removeAllSeries()
+        self.volchart.addSeries(volumeSeries)
+        self.volchart.createDefaultAxes()
 
-    
     def create_chart(self):
         self._chart_group = QGroupBox("Chart")
         self.chart = QChart()
         self.volchart = QChart()
         self.update_chart()
         self.chart.setTitle("Historical Data")
-        self.chart.setAnimationOptions(QChart.SeriesAnimations)
         self.chart.legend().setVisible(True)
         self.chart.legend().setAlignment(Qt.AlignBottom)
         self.volchart.setTitle("volume Data")
-        self.volchart.setAnimationOptions(QChart.SeriesAnimations)
         self.volchart.legend().setVisible(True)
         self.volchart.legend().setAlignment(Qt.AlignBottom)
         layout = QVBoxLayout()
@@ -1193,10 +966,20 @@ class BuyWindow(QWidget):
         self._chart_group.setLayout(layout)
 
 if __name__=="__main__":
+    setup_logging()
+    atexit.register(metrics.export)
     update_table()
+    trigger_book.load()
+    contract_cache.load()
     app = QApplication([])
+    # let asyncio drive Qt so IB ticks and order events are delivered while the window is up
+    ib.util.patchAsyncio()
+    ib.util.useQt('PySide6')
+    # built here so it keeps the loop current_ib.run drives
+    register('ib',IBProvider(current_ib,contract_cache))
     widget = TradeListWindow()
     widget.resize(800,600)
     widget.showMaximized()
 
-    sys.exit(app.exec())
+    app.lastWindowClosed.connect(ib.util.getLoop().stop)
+    current_ib.run()
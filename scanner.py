@@ -0,0 +1,520 @@
+#!/bin/env python3
+import csv
+import math
+import time
+import logging
+import argparse
+import threading
+import pandas as pd
+import numpy as np
+import settings
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+from charts import stop_below
+from db import con, update_table, writer
+from marketdata import chunked, fetch_summary, candle_store, quote_cache
+from metrics import metrics, setup_logging
+from providers import ReplayProvider, register, use_provider
+
+log = logging.getLogger(__name__)
+
+SHORTLIST_HEADERS = ['Ticker','Name','Price','Opt Size','Volume','Bear Steps','Bounce Steps','Swallow','Trade Count']
+SCORE_HEADERS = ['Bear Score','Bounce Score','Volume Score']
+SHORTLIST_QUERY = "select ticker,name,price,opt_size,volume,bear_steps,bounce_steps,pullbackswallow,tradecount,bear_score,bounce_score,vol_score from stocks where bear_steps > 0 and bounce_steps > 0 order by tradecount desc, volume desc, opt_size desc, bear_steps desc, bear_score desc, vol_score desc, bounce_steps desc, bounce_score desc"
+
+def find_levels(candles):
+    low = candles['low'].to_numpy()
+    high = candles['high'].to_numpy()
+    size_mean = np.mean(candles['high']-candles['low'])
+    support = support_mask(low)
+    resistance = resistance_mask(high) & ~support
+    candidates = np.where(support,low,high)[support | resistance]
+    # keeping a level depends on the ones kept before it, so only this
+    # short pass over the candidates stays sequential
+    levels = []
+    kept = []
+    for val, x in zip(candidates,candidates.tolist()):
+        if not any(abs(x-y) < size_mean for y in kept):
+            levels.append(val)
+            kept.append(x)
+    return size_mean,levels
+
+def fractal_mask(values,inner,outer):
+    # True at every i in [2,len-2) where inner holds between i and both
+    # neighbours and outer holds from each neighbour to the next bar out
+    values = np.asarray(values)
+    mask = np.zeros(len(values),dtype=bool)
+    if len(values) > 4:
+        mid = values[2:-2]
+        mask[2:-2] = inner(mid,values[1:-3]) & inner(mid,values[3:-1]) & outer(values[3:-1],values[4:]) & outer(values[1:-3],values[:-4])
+    return mask
+
+def support_mask(low):          # lowest lows
+    return fractal_mask(low,np.less_equal,np.less)
+
+def resistance_mask(high):      # highest highs
+    return fractal_mask(high,np.greater_equal,np.greater)
+
+def highest_low_mask(low):      # highest lows
+    return fractal_mask(low,np.greater_equal,np.greater)
+
+def lowest_high_mask(high):     # lowest highs
+    return fractal_mask(high,np.less_equal,np.less)
+
+def candle_size(candle):
+    return candle['high'] - candle['low']
+
+def red_candle(candle):
+    if candle['open'] > candle['close']:
+        return True
+    elif candle['open'] < candle['close']:
+        return False
+    else:
+        if candle['high'] - candle['close'] > candle['close'] - candle['low']:
+            return True
+        else:
+            return False
+
+def clean_bear_movement(first,second):
+    score = 0
+    if second['high']<=first['high']:
+        score += 1
+    if second['low']<=first['low']:
+        score += 1
+    if second['open']<=first['open']:
+        score += 1
+    if second['close']<=first['close']:
+        score += 1
+    return score
+
+def clean_bull_movement(first,second):
+    score = 0
+    if second['high']>=first['high']:
+        score += 1
+    if second['low']>=first['low']:
+        score += 1
+    if second['open']>=first['open']:
+        score += 1
+    if second['close']>=first['close']:
+        score += 1
+    return score
+
+def load_universe(path='zacks_list.csv'):
+    stocks = pd.read_csv(path,header=0)
+    universe = []
+    for i in range(len(stocks.index)-1):
+        if isinstance(stocks.iloc[i]['Ticker'], str):
+            universe.append((stocks.iloc[i]['Ticker'].upper(),stocks.iloc[i]['Company Name']))
+    return universe
+
+STOCKS_UPSERT = "insert into stocks (name,ticker,price,bear_score,bear_steps,vol_score,bounce_score,bounce_steps,pullbackswallow,opt_size,volume,tradecount,scanned_at) values (:name,:ticker,:price,:bear_score,:bear_steps,:vol_score,:bounce_score,:bounce_steps,:pullbackswallow,:opt_size,:volume,:tradecount,:scanned_at) on conflict(ticker) do update set name=excluded.name,price=excluded.price,bear_score=excluded.bear_score,bear_steps=excluded.bear_steps,vol_score=excluded.vol_score,bounce_score=excluded.bounce_score,bounce_steps=excluded.bounce_steps,pullbackswallow=excluded.pullbackswallow,opt_size=excluded.opt_size,volume=excluded.volume,tradecount=excluded.tradecount,scanned_at=excluded.scanned_at"
+
+def start_run(con,resume=True,writer=writer):
+    # a run that never reached finish_run was interrupted and is picked up again
+    if resume:
+        run = con.execute("select run_id from scan_runs where finished is null order by run_id desc").fetchone()
+        if run:
+            log.info("Resuming scan run %s",run[0])
+            return run[0]
+    return writer.execute("insert into scan_runs(started,status) values (:started,'Running')",{'started':datetime.now().strftime("%Y-%m-%d %H:%M:%S")}).result()
+
+def finish_run(run_id,status='Complete',writer=writer):
+    writer.execute("update scan_runs set status=:status,finished=:finished where run_id=:run_id",
+        {'run_id':run_id,'status':status,'finished':datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+
+def pending_universe(con,run_id,universe,stale_hours=0):
+    # drops tickers already checkpointed in this run and, when stale_hours
+    # is set, tickers scanned by any run within that many hours
+    done = set(row[0] for row in con.execute("select ticker from scan_checkpoint where run_id=:run_id",{'run_id':run_id}))
+    if stale_hours:
+        cutoff = (datetime.now() - timedelta(hours=stale_hours)).strftime("%Y-%m-%d %H:%M:%S")
+        done.update(row[0] for row in con.execute("select distinct ticker from scan_checkpoint where scanned_at>=:cutoff",{'cutoff':cutoff}))
+    return [(ticker,name) for ticker, name in universe if ticker not in done]
+
+def save_stock(row,writer=writer):
+    row = dict(row,scanned_at=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    writer.execute(STOCKS_UPSERT,row)
+
+def checkpoint(run_id,tickers,found,writer=writer):
+    # queued behind the chunk's save_stock calls, so a checkpoint is never
+    # committed ahead of the scores it stands for
+    scanned_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # a ticker that no longer qualifies should not keep its old scores
+    writer.executemany("delete from stocks where ticker=:ticker",[{'ticker':ticker} for ticker in tickers if ticker not in found])
+    writer.executemany("insert or replace into scan_checkpoint(run_id,ticker,scanned_at) values (:run_id,:ticker,:scanned_at)",
+        [{'run_id':run_id,'ticker':ticker,'scanned_at':scanned_at} for ticker in tickers])
+
+class StageClock:
+    def __init__(self):
+        self.stages = {}
+        self.last = time.perf_counter()
+
+    def lap(self,stage):
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage,0) + now - self.last
+        metrics.observe('scan.' + stage,now - self.last)
+        self.last = now
+
+def candle_arrays(candles):
+    return tuple(candles[column].to_numpy(dtype=float) for column in ('open','high','low','close'))
+
+def bar_scores(opens,highs,lows,closes):
+    # red_candle, clean_bull_movement and clean_bear_movement for every bar,
+    # the movement scores compare each bar with the one before it
+    red = (opens > closes) | (~(opens < closes) & (highs - closes > closes - lows))
+    bull = np.zeros(len(closes),dtype=int)
+    bear = np.zeros(len(closes),dtype=int)
+    for values in (highs,lows,opens,closes):
+        bull[1:] += values[1:] >= values[:-1]
+        bear[1:] += values[1:] <= values[:-1]
+    return red,bull,bear
+
+def score_bars(opens,highs,lows,closes):
+    red,bull,bear = bar_scores(opens,highs,lows,closes)
+    return score_window(red.tolist(),bull.tolist(),bear.tolist(),opens,closes,len(closes)-1)
+
+def score_window(red,bull,bear,opens,closes,end,start=0):
+    # walks back from bar end and never looks at the first three bars from
+    # start, bar_scores only compares neighbours so its arrays can be built
+    # once for a whole history and scored for any window of it
+    bear_score = 0
+    bounce_score = 0
+    bear_steps = 0
+    bounce_steps = 0
+    pos = end
+    stages = 0      # 0 - pullback, 1 - bear
+    pullbackhigh = None
+    pullbacklow = None
+    pullbackswallow = None
+    bearhigh = None
+    bearlow = None
+    while pos>start+2 and stages<2:
+        if stages == 0:
+            if bull[pos]>2 and not red[pos]:
+                bounce_steps += 1
+                if not pullbackhigh:
+                    pullbackhigh = closes[pos]
+            else:
+                if not red[pos] and bounce_steps==0:
+                    bounce_steps += 1
+                    pullbackhigh = closes[pos]
+                stages = 1
+                if pullbackhigh and not pullbacklow:
+                    pullbacklow = opens[pos]
+        elif stages == 1:
+            if bear[pos]>2 and red[pos]:
+                bear_steps += 1
+                if not bearlow:
+                    bearlow = closes[pos]
+            else:
+                stages = 2
+                if bearlow and not bearhigh:
+                    bearhigh = opens[pos]
+        if pullbackhigh and pullbackhigh > closes[pos]:
+            if pullbackswallow:
+                pullbackswallow += 1
+            else:
+                pullbackswallow = 1
+        if bounce_steps>2 and stages<1:     # we don't want any extended bull run
+            stages = 1
+        pos -= 1
+
+    if bear_steps>0 and bearhigh and bearlow:
+        bear_score = (bearhigh - bearlow) / bear_steps
+    if bounce_steps>0 and pullbackhigh and pullbacklow:
+        bounce_score = (pullbackhigh - pullbacklow) / bounce_steps
+    return {
+        'bear_score':bear_score,
+        'bear_steps':bear_steps,
+        'bounce_score':bounce_score,
+        'bounce_steps':bounce_steps,
+        'pullbackswallow':pullbackswallow
+        }
+
+def score_steps(candles):
+    return score_bars(*candle_arrays(candles))
+
+def score_levels(candles,curprice):
+    opt_size = 0
+    size_mean,levels = find_levels(candles)
+    levels.sort()
+    end_vol = candles.iloc[-1:-5:-1]['volume'].mean()
+    all_vol = candles['volume'].mean()
+    vol_score = end_vol / all_vol
+    if len(levels)>0 and curprice<levels[-1]:
+        l = 0
+        while l<len(levels)-1 and curprice>levels[l]:
+            l+=1
+        opt_size = levels[l] - curprice
+    return vol_score,opt_size
+
+def targets(levels,price):
+    # R1 and R2 the way BuyWindow fills them in, the first levels above price
+    r1 = math.ceil(price)
+    r2 = None
+    if len(levels)>0 and price<levels[-1]:
+        i = 0
+        while i<len(levels)-1 and price>levels[i]:
+            i+=1
+        r1 = levels[i]
+        j = i + 1
+        while j<len(levels) and price>levels[j]:
+            j+=1
+        if j<len(levels):
+            r2 = levels[j]
+    return r1,r2
+
+def buy_levels(candles,price):
+    # the levels, stop and targets BuyWindow shows once candles and price are in
+    size_mean,levels = find_levels(candles)
+    levels.sort()
+    r1,r2 = targets(levels,price)
+    return {'size_mean':size_mean,'levels':levels,'stop':stop_below(candles['low'].to_numpy(),price),'r1':r1,'r2':r2}
+
+def scan_chunk(chunk,start_date,end_date,clock,timeout=None):
+    names = dict(chunk)
+    tickers = list(names)
+    histories = candle_store.history(tickers,start_date,end_date,timeout=timeout)
+    clock.lap('history')
+    prices = quote_cache.get_many(tickers,timeout=timeout)
+    clock.lap('price')
+    found = []
+    for ticker in tickers:
+        with metrics.timer('scan.ticker'):
+            candles = histories.get(ticker)
+            curprice = prices.get(ticker) or 0
+            if candles is None or len(candles.index)<=3 or curprice<=0.1:
+                continue
+            scores = score_steps(candles)
+            clock.lap('scoring')
+            if scores['bear_steps'] == 0:
+                continue
+            vol_score,opt_size = score_levels(candles,curprice)
+            clock.lap('levels')
+            log.debug("Found bear end for %s score of %s vol score: %s",ticker,scores['bear_score'],vol_score)
+            scores.update({
+                'name':names[ticker],
+                'ticker':ticker,
+                'price':curprice,
+                'vol_score':vol_score,
+                'opt_size':opt_size
+                })
+            found.append(scores)
+    metrics.count('scan.tickers',len(tickers))
+    metrics.count('scan.found',len(found))
+    if found:
+        candidates = [row['ticker'] for row in found]
+        minute_start_date = end_date - timedelta(days=3)
+        minute_candles = candle_store.history(candidates,minute_start_date,end_date,interval='5m',timeout=timeout)
+        clock.lap('intraday')
+        summary = fetch_summary(candidates,timeout=timeout)
+        clock.lap('summary')
+        for row in found:
+            minute = minute_candles.get(row['ticker'])
+            row['tradecount'] = 0 if minute is None else minute.shape[0]
+            row['volume'] = summary.get(row['ticker'],{}).get('volume',0)
+    return found
+
+class ScanEngine:
+    def __init__(self,workers=None,ticker_timeout=None,chunk_size=None,chunk_timeout=None):
+        self.workers = workers or getattr(settings,'scan_workers',8)
+        self.ticker_timeout = ticker_timeout or getattr(settings,'scan_ticker_timeout',120)
+        self.chunk_size = chunk_size or getattr(settings,'scan_chunk_size',50)
+        self.chunk_timeout = chunk_timeout or getattr(settings,'scan_chunk_timeout',600)
+        self.stage_times = {}
+        self.scanned = 0
+        self.found = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.took = timedelta()
+        self.start_time = None
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def eta(self,total):
+        if not self.scanned:
+            return None
+        elapsed = datetime.now() - self.start_time
+        return elapsed / self.scanned * (total - self.scanned)
+
+    def _work(self,job,start_date,end_date):
+        clock = StageClock()
+        try:
+            with metrics.timer('scan.chunk'):
+                return scan_chunk(job['chunk'],start_date,end_date,clock,timeout=self.ticker_timeout)
+        finally:
+            job['stages'] = clock.stages
+
+    def _collect(self,job):
+        for stage, seconds in job.get('stages',{}).items():
+            self.stage_times[stage] = self.stage_times.get(stage,0) + seconds
+
+    def run(self,universe,on_result,days=120,on_checkpoint=None,on_progress=None):
+        end_date = datetime.now()
+        start_date = end_date - timedelta(days=days)
+        self.start_time = datetime.now()
+        total = len(universe)
+        todo = chunked(universe,self.chunk_size)
+        pending = {}
+        abandoned = set()
+        exhausted = False
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            while (pending or not exhausted) and not self.cancelled.is_set():
+                # a timed out chunk keeps its thread until it returns, so
+                # nothing more is submitted than there are free threads and
+                # every chunk starts as soon as it is submitted
+                abandoned = {future for future in abandoned if not future.done()}
+                while not exhausted and len(pending) + len(abandoned) < self.workers:
+                    try:
+                        chunk = next(todo)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    job = {'chunk':chunk,'submitted':time.monotonic()}
+                    pending[executor.submit(self._work,job,start_date,end_date)] = job
+                if not pending:
+                    if exhausted or not abandoned:
+                        break
+                    wait(abandoned,timeout=1,return_when=FIRST_COMPLETED)
+                    continue
+                done, _ = wait(pending,timeout=1,return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = pending.pop(future)
+                    self.scanned += len(job['chunk'])
+                    self._collect(job)
+                    try:
+                        results = future.result()
+                    except Exception as exp:
+                        self.errors += 1
+                        metrics.error('scan',exp)
+                        log.error("Scanning %s to %s got error: %s",job['chunk'][0][0],job['chunk'][-1][0],exp)
+                        continue
+                    for result in results:
+                        self.found += 1
+                        on_result(result)
+                    if on_checkpoint:
+                        on_checkpoint([ticker for ticker, name in job['chunk']],[result['ticker'] for result in results])
+                now = time.monotonic()
+                for future, job in list(pending.items()):
+                    if now - job['submitted'] > self.chunk_timeout:
+                        # the worker thread cannot be killed, stop waiting on it and move on
+                        pending.pop(future)
+                        abandoned.add(future)
+                        self.scanned += len(job['chunk'])
+                        self.timeouts += 1
+                        metrics.count('scan.timeouts')
+                        log.warning("Scanning %s to %s timed out",job['chunk'][0][0],job['chunk'][-1][0])
+                if on_progress:
+                    on_progress(self.scanned,total,self.eta(total))
+        finally:
+            executor.shutdown(wait=False,cancel_futures=True)
+        self.took = datetime.now() - self.start_time
+        return self.took
+
+    def report(self):
+        lines = ["Took " + str(self.took) + " for " + str(self.scanned) + " tickers with " + str(self.workers) + " workers"]
+        if self.cancelled.is_set():
+            lines.append("Cancelled, the next scan resumes where this one stopped")
+        lines.append("Found " + str(self.found) + ", errors " + str(self.errors) + ", timeouts " + str(self.timeouts))
+        for stage, seconds in self.stage_times.items():
+            lines.append(stage + ": " + str(timedelta(seconds=round(seconds))))
+        return "\n".join(lines)
+
+def run_scan(con,universe_path='zacks_list.csv',days=120,workers=None,stale_hours=0,resume=True,engine=None,on_result=None,on_progress=None):
+    universe = load_universe(universe_path)
+    run_id = start_run(con,resume)
+    universe = pending_universe(con,run_id,universe,stale_hours)
+    log.info("Scan run %s has %s tickers to scan",run_id,len(universe))
+    if engine is None:
+        engine = ScanEngine(workers=workers)
+    def save_result(result):
+        save_stock(result)
+        if on_result:
+            on_result(result)
+    engine.run(universe,save_result,days=days,
+        on_checkpoint=lambda tickers,found: checkpoint(run_id,tickers,found),on_progress=on_progress)
+    if not engine.cancelled.is_set():
+        finish_run(run_id)
+    writer.flush()
+    metrics.export()
+    log.info("Done scanning\n%s",engine.report())
+    return engine
+
+EXPORT_HEADERS = SHORTLIST_HEADERS + SCORE_HEADERS + ['Latest close','Colour','Gap','Candle Size','Gap Size']
+
+def export_chunk(chunk,start_date,end_date):
+    # daily bars come from candle_store, so tickers the scan just fetched
+    # are not downloaded again
+    rows = []
+    try:
+        histories = candle_store.history([stock[0] for stock in chunk],start_date,end_date)
+    except Exception as exp:
+        metrics.error('export',exp)
+        log.error("Processing %s to %s got error: %s",chunk[0][1],chunk[-1][1],exp)
+        return rows
+    for stock in chunk:
+        try:
+            candles = histories[stock[0]]
+            latest = candles.iloc[-1]
+            secondlatest = candles.iloc[-2]
+            color = 'Green'
+            if red_candle(latest):
+                color = 'Red'
+            gap = 'Up'
+            if latest['open']<secondlatest['close']:
+                gap = 'Down'
+            gapsize = latest['open'] - secondlatest['close']
+            rows.append(stock + tuple([latest['close'],color,gap,candle_size(latest),gapsize]))
+        except Exception as exp:
+            metrics.error('export',exp)
+            log.error("Processing %s got error: %s",stock[1],exp)
+    return rows
+
+def export_shortlist(con,workers=None,on_progress=None):
+    shortlist = con.execute(SHORTLIST_QUERY).fetchall()
+    filename = 'shortlist_' + datetime.now().strftime("%Y_%m_%d_%H_%M_%S") + '.csv'
+    end_date = datetime.now()
+    days = 5
+    start_date = end_date - timedelta(days=days)
+    chunks = list(chunked(shortlist,getattr(settings,'scan_chunk_size',50)))
+    done = 0
+    with open(filename,'w') as f, ThreadPoolExecutor(max_workers=workers or getattr(settings,'scan_workers',8)) as executor:
+        out = csv.writer(f)
+        out.writerow(EXPORT_HEADERS)
+        # map hands chunks back in shortlist order, each one is written as
+        # soon as it and the ones before it are ready
+        for chunk, rows in zip(chunks,executor.map(lambda chunk: export_chunk(chunk,start_date,end_date),chunks)):
+            out.writerows(rows)
+            f.flush()
+            done += len(chunk)
+            if on_progress:
+                on_progress(done,len(shortlist))
+    log.info("Done export")
+    return filename
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the stock scanner without the GUI and export the shortlist")
+    parser.add_argument('--universe',default='zacks_list.csv',help="csv with Ticker and Company Name columns")
+    parser.add_argument('--days',type=int,default=120,help="days of daily candles to score")
+    parser.add_argument('--workers',type=int,default=None,help="concurrent fetch workers, defaults to settings.scan_workers")
+    parser.add_argument('--stale-hours',type=float,default=0,help="skip tickers scanned within this many hours")
+    parser.add_argument('--restart',action='store_true',help="start a new run instead of resuming an interrupted one")
+    parser.add_argument('--no-export',action='store_true',help="do not write the shortlist csv")
+    parser.add_argument('--provider',choices=['yahoo','replay'],default=None,help="market data source for every fetch, defaults to the *_provider settings")
+    parser.add_argument('--replay-path',default=None,help="database or csv directory the replay provider reads, defaults to settings.replay_path")
+    args = parser.parse_args(argv)
+    setup_logging()
+    if args.replay_path:
+        register('replay',ReplayProvider(args.replay_path))
+    if args.provider:
+        use_provider(args.provider)
+    update_table()
+    run_scan(con,args.universe,args.days,args.workers,args.stale_hours,resume=not args.restart)
+    if not args.no_export:
+        print("Shortlist written to",export_shortlist(con))
+
+if __name__=="__main__":
+    main()
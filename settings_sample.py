@@ -1 +1,42 @@
-alphavantage_key = 'enter_key_here'
\ No newline at end of file
+alphavantage_key = 'enter_key_here'
+scan_workers = 8
+# seconds each yahooquery request of a scan may take, passed to requests
+# as its HTTP timeout; it does not bound a whole ticker or chunk
+scan_ticker_timeout = 120
+scan_chunk_size = 50
+# seconds a chunk of scan_chunk_size tickers may take from being handed to
+# a worker until the scan stops waiting on it and counts it as timed out
+scan_chunk_timeout = 600
+candle_refresh = 900
+quote_ttl = 15
+quote_cache_size = 2000
+# seconds a batched quote request may take
+quote_timeout = 10
+scan_stale_hours = 12
+contract_refresh = 86400
+db_batch_size = 500
+db_flush_interval = 1
+chart_animation_bars = 150
+snapshot_ttl = 60
+news_refresh = 1800
+news_per_minute = 5
+news_burst = 5
+# seconds a news lookup waits for the rate limit and for Alphavantage to answer
+news_timeout = 5
+# 'yahoo' polls prices every minute, 'ib' streams IB market data for open positions
+price_source = 'yahoo'
+# DEBUG also logs every ticker scanned and every price checked
+log_level = 'INFO'
+metrics_path = 'metrics.json'
+# seconds between metrics exports while the GUI runs, it also exports after a scan and at exit
+metrics_interval = 600
+# market data source per call site: 'yahoo', 'ib' (GUI only, uses the IB
+# connection) or 'replay' (recorded candles from replay_path, no network)
+history_provider = 'yahoo'
+intraday_provider = 'yahoo'
+quote_provider = 'yahoo'
+summary_provider = 'yahoo'
+# database with a candles table, or a directory of TICKER_INTERVAL.csv files
+replay_path = 'qtrader.db'
+# seconds to wait for an IB market data request before giving up
+ib_timeout = 60
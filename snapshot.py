@@ -0,0 +1,92 @@
+import time
+import logging
+import threading
+import settings
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from marketdata import candle_store, latest_price
+from providers import get_provider
+from news import news_store
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+def fetch_modules(ticker):
+    # summary detail, price and calendar events in one request instead of
+    # one per attribute read, only yahoo has these
+    return get_provider('yahoo').modules(ticker,['summaryDetail','price','calendarEvents'])
+
+def fetch_news(ticker):
+    return news_store.feed(ticker)
+
+def fetch_news_update(ticker):
+    # None when the stored news was fresh enough and nothing was fetched
+    if news_store.update(ticker) is None:
+        return None
+    return news_store.feed(ticker)
+
+def fetch_candles(ticker,days=120):
+    end_date = datetime.now()
+    start_date = end_date - timedelta(days=days)
+    return candle_store.history([ticker],start_date,end_date)[ticker]
+
+def fetch_price(ticker):
+    return latest_price(ticker)
+
+PARTS = {
+    'modules':fetch_modules,
+    'news':fetch_news,
+    'news_update':fetch_news_update,
+    'candles':fetch_candles,
+    'price':fetch_price,
+}
+
+class SnapshotCache:
+    # everything BuyWindow shows for a ticker, kept for ttl seconds so
+    # reopening the same ticker does not fetch anything
+    def __init__(self,ttl=None):
+        self.ttl = ttl or getattr(settings,'snapshot_ttl',60)
+        self.snapshots = {}
+        self.lock = threading.Lock()
+
+    def get(self,ticker):
+        now = time.monotonic()
+        with self.lock:
+            return {part:value for part, (value,fetched) in self.snapshots.get(ticker,{}).items() if now - fetched < self.ttl}
+
+    def put(self,ticker,part,value):
+        with self.lock:
+            self.snapshots.setdefault(ticker,{})[part] = (value,time.monotonic())
+
+    def invalidate(self,ticker=None):
+        with self.lock:
+            if ticker:
+                self.snapshots.pop(ticker,None)
+            else:
+                self.snapshots.clear()
+
+    def load(self,ticker,on_part):
+        # on_part(part,value) for the cached parts first, then for the rest
+        # as each fetch finishes, all of them fetched at the same time
+        cached = self.get(ticker)
+        for part, value in cached.items():
+            on_part(part,value)
+        missing = [part for part in PARTS if part not in cached]
+        if not missing:
+            return
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            futures = {executor.submit(PARTS[part],ticker):part for part in missing}
+            for future in as_completed(futures):
+                part = futures[future]
+                try:
+                    value = future.result()
+                except Exception as exp:
+                    metrics.error('snapshot.' + part,exp)
+                    log.warning("Can't get %s for %s: %s",part,ticker,exp)
+                    continue
+                if value is None:
+                    continue
+                self.put(ticker,part,value)
+                on_part(part,value)
+
+snapshot_cache = SnapshotCache()
@@ -0,0 +1,115 @@
+import bisect
+import logging
+import weakref
+from db import writer
+
+log = logging.getLogger(__name__)
+
+class TriggerBook:
+    # Active triggers per ticker kept as price ladders sorted ascending, so a
+    # price check is a bisect instead of two queries. Every change is queued
+    # on writer straight away, con is only read from.
+    def __init__(self,con,writer=writer):
+        self.con = con
+        self.writer = writer
+        self.ladders = {}
+        self.active = {}
+        self.listeners = []
+
+    def listen(self,callback):
+        # callback(trigger_id,fields) after every change, fields holds the
+        # columns that changed. Bound methods are held weakly so a closed
+        # window does not have to unregister.
+        self.listeners.append(weakref.WeakMethod(callback))
+
+    def notify(self,trigger_id,fields):
+        for listener in list(self.listeners):
+            callback = listener()
+            if callback is None:
+                self.listeners.remove(listener)
+            else:
+                callback(trigger_id,fields)
+
+    def load(self):
+        self.ladders = {}
+        self.active = {}
+        for trigger_id, ticker, trigger_type, price in self.con.execute("select trigger_id,ticker,trigger_type,price from trigger where status='Active'"):
+            try:
+                self._insert(trigger_id,ticker,trigger_type,float(price))
+            except (TypeError,ValueError):
+                log.warning("Skipping trigger %s with price %s",trigger_id,price)
+
+    def _insert(self,trigger_id,ticker,trigger_type,price):
+        ladder = self.ladders.setdefault(ticker,{'Above':[],'Below':[]}).setdefault(trigger_type,[])
+        bisect.insort(ladder,(price,trigger_id))
+        self.active[trigger_id] = (ticker,trigger_type,price)
+
+    def _remove(self,trigger_id):
+        if trigger_id not in self.active:
+            return
+        ticker, trigger_type, price = self.active.pop(trigger_id)
+        ladder = self.ladders[ticker][trigger_type]
+        del ladder[bisect.bisect_left(ladder,(price,trigger_id))]
+
+    def ladder(self,ticker,trigger_type):
+        return self.ladders.get(ticker,{}).get(trigger_type,[])
+
+    def _divide(self,ladder):
+        # number of other active triggers of the same type, at least 1
+        return max(len(ladder)-1,1)
+
+    def crossed_above(self,ticker,price):
+        # lowest Above trigger when price is past it, as (trigger_id,trigger_price,divide)
+        ladder = self.ladder(ticker,'Above')
+        if bisect.bisect_left(ladder,(price,)) == 0:
+            return None
+        trigger_price, trigger_id = ladder[0]
+        return trigger_id,trigger_price,self._divide(ladder)
+
+    def crossed_below(self,ticker,price):
+        # highest Below trigger when price is under it
+        ladder = self.ladder(ticker,'Below')
+        if bisect.bisect_right(ladder,(price,float('inf'))) == len(ladder):
+            return None
+        trigger_price, trigger_id = ladder[-1]
+        return trigger_id,trigger_price,self._divide(ladder)
+
+    def add(self,trade_date,ticker,status,trigger_type,price):
+        trigger_id = self.writer.execute("insert into trigger(trade_date,ticker,status,trigger_type,price) values (:trade_date,:ticker,:status,:trigger_type,:price)",
+            {'trade_date':trade_date,'ticker':ticker,'status':status,'trigger_type':trigger_type,'price':price}).result()
+        if status == 'Active':
+            self._insert(trigger_id,ticker,trigger_type,float(price))
+        self.notify(trigger_id,{'trade_date':trade_date,'ticker':ticker,'status':status,'trigger_type':trigger_type,'price':price})
+        return trigger_id
+
+    def update(self,trigger_id,price,status,trigger_type):
+        self.writer.execute("update trigger set price=:price,status=:status,trigger_type=:type where trigger_id=:id",
+            {'id':trigger_id,'price':price,'status':status,'type':trigger_type})
+        self._remove(trigger_id)
+        if status == 'Active':
+            self.writer.flush()
+            ticker = self.con.execute("select ticker from trigger where trigger_id=:id",{'id':trigger_id}).fetchone()[0]
+            self._insert(trigger_id,ticker,trigger_type,float(price))
+        self.notify(trigger_id,{'price':price,'status':status,'trigger_type':trigger_type})
+
+    def set_status(self,trigger_id,status,close_date):
+        self.writer.execute("update trigger set status=:status,close_date=:close_date where trigger_id=:id",
+            {'id':trigger_id,'status':status,'close_date':close_date})
+        self._remove(trigger_id)
+        if status == 'Active':
+            self.writer.flush()
+            ticker, trigger_type, price = self.con.execute("select ticker,trigger_type,price from trigger where trigger_id=:id",{'id':trigger_id}).fetchone()
+            self._insert(trigger_id,ticker,trigger_type,float(price))
+        self.notify(trigger_id,{'status':status,'close_date':close_date})
+
+    def cancel_ticker(self,ticker,close_date):
+        # returns the ids of the Active triggers it cancelled
+        cancelled = []
+        self.writer.execute("update trigger set status='Cancel',close_date=:close_date where ticker=:ticker and status='Active'",
+            {'ticker':ticker,'close_date':close_date})
+        for trigger_type in ('Above','Below'):
+            for price, trigger_id in list(self.ladder(ticker,trigger_type)):
+                self._remove(trigger_id)
+                cancelled.append(trigger_id)
+                self.notify(trigger_id,{'status':'Cancel','close_date':close_date})
+        return cancelled